@@ -0,0 +1,582 @@
+import os
+import json
+import atexit
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+db_fields = ['word', 'time', 'counts', 'count_noRT', 'rank', 'rank_noRT', 'freq', 'freq_noRT']
+
+pool_size = 8
+max_idle_time = 60
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(username='guest', pwd='roboctopus', host='hydra.uvm.edu', port=27017):
+    """Get a shared client for a database server
+
+    Clients are created once per server and credentials,
+    and reused by every backend in the process
+
+    Args:
+        username: username to access database
+        pwd: password to access database
+        host: hostname of the database server
+        port: port of the database server
+
+    Returns (pymongo.MongoClient):
+        a pooled client
+    """
+    # pymongo is only loaded once a database server is actually used
+    from pymongo import MongoClient
+
+    key = (host, port, username, pwd)
+
+    with _clients_lock:
+        if key not in _clients:
+            logger.info(f'Connecting: {username}@{host}:{port}')
+            _clients[key] = MongoClient(
+                f'mongodb://{username}:{pwd}@{host}:{port}',
+                maxPoolSize=pool_size,
+                maxIdleTimeMS=max_idle_time * 1000,
+            )
+        return _clients[key]
+
+
+def projection(fields=None):
+    """List document fields to fetch
+
+    Args:
+        fields (list): list of fields to fetch in addition to `word` and `time` (defaults to all)
+
+    Returns (list):
+        list of database field names
+    """
+    if fields is None:
+        return db_fields
+    return ['word', 'time'] + [f for f in fields if f not in ('word', 'time')]
+
+
+def casefold(words):
+    """Fold the capitalization of n-grams to match them regardless of case
+
+    Dots above left by folding a dotted capital I (e.g. Turkish 'İzmir') are dropped,
+    so that every capitalization folds to the same key ('izmir')
+
+    Args:
+        words (string or pd.Series): an n-gram or a series of n-grams
+
+    Returns (string or pd.Series):
+        case-folded n-grams
+    """
+    if isinstance(words, str):
+        return words.casefold().replace('\u0307', '')
+    return words.astype(str).str.casefold().str.replace('\u0307', '', regex=False)
+
+
+def daily_batch(days, columns, categories):
+    """Flatten records of parallel arrays into a batch of documents
+
+    Args:
+        days (list): list of records grouped by day
+        columns (list): list of database field names
+        categories (pd.Index): requested n-grams
+
+    Returns (pd.DataFrame):
+        batch of raw documents with the database field names (`word` is categorical)
+    """
+    sizes = [len(d['word']) for d in days]
+    df = {'time': np.repeat(np.array([d['_id'] for d in days], dtype='datetime64[ns]'), sizes)}
+    for c in columns:
+        if c == 'word':
+            df[c] = pd.Categorical(np.concatenate([d[c] for d in days]), categories=categories)
+        elif c != 'time':
+            df[c] = np.concatenate([d[c] for d in days])
+    return pd.DataFrame(df, columns=columns)
+
+
+@atexit.register
+def close_clients():
+    """Close all shared clients and their connection pools"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+class CaseIndex:
+    """Class to keep a local lookup of capitalizations of n-grams in a collection
+
+    The lookup maps every case-folded n-gram to the capitalizations found in the collection,
+    so case-insensitive queries can use the ordinary index on `word` instead of a collation.
+    Capitalizations are discovered once, then refreshed only from the days since the last lookup
+    """
+
+    # one lock per lookup file, only held while the file is read or written
+    locks = {}
+    locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        """Open a lookup file
+
+        Args:
+            path (pathlib.Path): path to the JSON file
+        """
+        self.path = Path(path)
+        with self.locks_lock:
+            self.lock = self.locks.setdefault(str(self.path.resolve()), threading.Lock())
+
+    def read(self):
+        """Read the lookup
+
+        Returns (dict):
+            capitalizations and date of the last lookup keyed by case-folded n-gram
+        """
+        if not self.path.exists():
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def variants(self, word_list, discover):
+        """List all capitalizations of n-grams
+
+        Args:
+            word_list (list): list of n-grams
+            discover (callable): function to find capitalizations of case-folded n-grams
+                since a given date, e.g. `MongoBackend.discover`
+
+        Returns (list):
+            list of n-grams matching the list regardless of capitalization
+        """
+        today = datetime.date.today()
+        keys = list(dict.fromkeys(casefold(w) for w in word_list))
+
+        with self.lock:
+            index = self.read()
+
+        stale = {}
+        for k in keys:
+            if k not in index:
+                stale.setdefault(None, []).append(k)
+            elif index[k]['updated'] < today.isoformat():
+                stale.setdefault(index[k]['updated'], []).append(k)
+
+        # the lookup is not locked while the database is queried
+        found = {}
+        for since, ks in stale.items():
+            start = datetime.datetime.fromisoformat(since) if since else None
+            for w in discover(ks, start_time=start):
+                found.setdefault(casefold(w), set()).add(w)
+
+        if stale:
+            with self.lock:
+                # other threads may have updated the lookup in the meantime
+                index = self.read()
+                for k in (k for ks in stale.values() for k in ks):
+                    old = index.get(k, {}).get('variants', [])
+                    index[k] = {'updated': today.isoformat(), 'variants': sorted(found.get(k, set()).union(old))}
+
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_suffix('.tmp')
+                with open(tmp, 'w') as f:
+                    json.dump(index, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+
+        return sorted({v for k in keys for v in index[k]['variants']}) or list(word_list)
+
+
+class MongoBackend:
+    """Backend to read n-gram documents from the MongoDB server"""
+
+    def __init__(
+            self,
+            db,
+            lang,
+            username='guest',
+            pwd='roboctopus',
+            host='hydra.uvm.edu',
+            port=27017,
+            case_index=None,
+    ):
+        """Connect to a language collection on hydra.uvm.edu
+
+        Args:
+            db: database to use
+            lang: language collection to use
+            username: username to access database
+            pwd: password to access database
+            host: hostname of the database server
+            port: port of the database server
+            case_index (pathlib.Path): path to a local directory of case-folded lookups
+        """
+        from pymongo.collation import Collation, CollationStrength
+
+        client = get_client(username=username, pwd=pwd, host=host, port=port)
+        self.tweets = client[db][lang]
+        self.lang = lang
+        self.case_index = CaseIndex(Path(case_index) / db / f'{lang}.json') if case_index else None
+        self.collation = Collation(locale=lang, strength=CollationStrength.SECONDARY)
+
+    def discover(self, keys, start_time=None):
+        """List all capitalizations of n-grams found in the collection
+
+        Args:
+            keys (list): list of case-folded n-grams
+            start_time (datetime): only look at documents from this date on
+
+        Returns (list):
+            list of n-grams matching the keys regardless of capitalization
+        """
+        query = {'word': {'$in': list(keys)}}
+        if start_time:
+            query['time'] = {'$gte': start_time}
+        return self.tweets.distinct('word', query, collation=self.collation)
+
+    def match(self, word_list, case_insensitive=False):
+        """Build a query on n-grams, looking up capitalizations in the case index when available
+
+        Args:
+            word_list (list): list of strings to query mongo
+            case_insensitive (bool): a toggle to match n-grams regardless of capitalization
+
+        Returns (tuple):
+            query on the `word` field and collation to use (None if not needed)
+        """
+        if not case_insensitive:
+            return {'$in': list(word_list)}, None
+        if self.case_index is None:
+            return {'$in': list(word_list)}, self.collation
+        return {'$in': self.case_index.variants(word_list, self.discover)}, None
+
+    def find(self, word_list, start_time=None, fields=None, case_insensitive=False, end_time=None):
+        """Fetch daily documents for a list of n-grams
+
+        Args:
+            word_list (list): list of strings to query mongo
+            start_time (datetime): starting date for query
+            fields (list): list of fields to fetch in addition to `word` and `time` (defaults to all)
+            case_insensitive (bool): a toggle to match n-grams regardless of capitalization
+            end_time (datetime): ending date for query (exclusive)
+
+        Returns (pd.DataFrame):
+            dataframe of raw documents with the database field names
+        """
+        columns = projection(fields)
+        words, collation = self.match(word_list, case_insensitive)
+        query = {'word': words}
+        if start_time or end_time:
+            query['time'] = {}
+            if start_time:
+                query['time']['$gte'] = start_time
+            if end_time:
+                query['time']['$lt'] = end_time
+
+        cursor = self.tweets.find(query, {'_id': 0, **{c: 1 for c in columns}})
+        if collation is not None:
+            cursor = cursor.collation(collation)
+
+        return pd.DataFrame.from_records(cursor, columns=columns)
+
+    def iter_daily(self, word_list, start_time=None, fields=None, batch_size=50000, case_insensitive=False):
+        """Stream daily documents for a list of n-grams grouped by day on the server
+
+        Documents are projected and grouped into one record of parallel arrays per day
+        by an aggregation pipeline, so only the requested fields are transferred,
+        and the cursor is consumed a few days at a time
+
+        Args:
+            word_list (list): list of strings to query mongo
+            start_time (datetime): starting date for query
+            fields (list): list of fields to fetch in addition to `word` and `time` (defaults to all)
+            batch_size (int): approximate number of documents per batch
+            case_insensitive (bool): a toggle to match n-grams regardless of capitalization
+
+        Yields (pd.DataFrame):
+            batches of raw documents with the database field names (`word` is categorical)
+        """
+        columns = projection(fields)
+        words, collation = self.match(list(dict.fromkeys(word_list)), case_insensitive)
+        categories = None if collation else pd.Index(words['$in'])
+        match = {'word': words}
+        if start_time:
+            match['time'] = {'$gte': start_time}
+
+        pipeline = [
+            {'$match': match},
+            {'$group': {'_id': '$time', **{c: {'$push': f'${c}'} for c in columns if c != 'time'}}},
+            {'$sort': {'_id': 1}},
+        ]
+
+        days, size = [], 0
+        options = dict(allowDiskUse=True, batchSize=max(1, batch_size // max(1, len(words['$in']))))
+        if collation is not None:
+            options['collation'] = collation
+
+        for d in self.tweets.aggregate(pipeline, **options):
+            days.append(d)
+            size += len(d['word'])
+
+            if size >= batch_size:
+                yield daily_batch(days, columns, categories)
+                days, size = [], 0
+
+        if days:
+            yield daily_batch(days, columns, categories)
+
+
+class ParquetBackend:
+    """Backend to read n-gram documents from a local columnar store
+
+    The store keeps one Parquet file per day for each language collection:
+    `{root}/{db}/{lang}/{YYYY-MM-DD}.parquet`
+    """
+
+    def __init__(self, db, lang, root):
+        """Open a language collection in a local store
+
+        Args:
+            db: database to use
+            lang: language collection to use
+            root (pathlib.Path): path to the local store
+        """
+        self.path = Path(root) / db / lang
+        self.lang = lang
+
+    def days(self, start_time=None, end_time=None):
+        """List daily partitions in the store
+
+        Args:
+            start_time (datetime): starting date for query
+            end_time (datetime): ending date for query (exclusive)
+
+        Returns (list):
+            sorted list of (date, pathlib.Path) tuples
+        """
+        days = []
+        for f in self.path.glob('*.parquet'):
+            d = datetime.date.fromisoformat(f.stem)
+            if (start_time is None or d >= start_time.date()) and (end_time is None or d < end_time.date()):
+                days.append((d, f))
+        return sorted(days)
+
+    def find(self, word_list, start_time=None, fields=None, case_insensitive=False, end_time=None):
+        """Fetch daily documents for a list of n-grams
+
+        Args:
+            word_list (list): list of strings to query
+            start_time (datetime): starting date for query
+            fields (list): list of fields to fetch in addition to `word` and `time` (defaults to all)
+            case_insensitive (bool): a toggle to match n-grams regardless of capitalization
+            end_time (datetime): ending date for query (exclusive)
+
+        Returns (pd.DataFrame):
+            dataframe of raw documents with the database field names
+        """
+        columns = projection(fields)
+        if case_insensitive:
+            filters = [('key', 'in', list({casefold(w) for w in word_list}))]
+        else:
+            filters = [('word', 'in', list(word_list))]
+
+        parts = [
+            pd.read_parquet(f, columns=columns, filters=filters)
+            for d, f in self.days(start_time, end_time)
+        ]
+
+        if not parts:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(parts, ignore_index=True)
+
+    def iter_daily(self, word_list, start_time=None, fields=None, batch_size=50000, case_insensitive=False):
+        """Stream daily documents for a list of n-grams one partition at a time
+
+        Args:
+            word_list (list): list of strings to query
+            start_time (datetime): starting date for query
+            fields (list): list of fields to fetch in addition to `word` and `time` (defaults to all)
+            batch_size (int): maximum number of documents per batch
+            case_insensitive (bool): a toggle to match n-grams regardless of capitalization
+
+        Yields (pd.DataFrame):
+            batches of raw documents with the database field names (`word` is categorical)
+        """
+        columns = projection(fields)
+        categories = pd.Index(list(dict.fromkeys(word_list)))
+        on = 'key' if case_insensitive else 'word'
+        value_set = pa.array(list({casefold(w) for w in categories} if case_insensitive else categories))
+
+        for d, f in self.days(start_time):
+            for batch in pq.ParquetFile(f).iter_batches(batch_size=batch_size, columns=columns + [on]):
+                batch = batch.filter(pc.is_in(batch.column(on), value_set=value_set))
+                if batch.num_rows:
+                    df = batch.to_pandas()[columns]
+                    df['word'] = pd.Categorical(df['word'], categories=None if case_insensitive else categories)
+                    yield df
+
+    def ingest(self, docs):
+        """Upsert documents into their daily partitions
+
+        Args:
+            docs (pd.DataFrame): dataframe of raw documents with the database field names
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        docs = docs[db_fields].copy()
+        docs['time'] = pd.to_datetime(docs['time'])
+        docs['key'] = casefold(docs['word'])
+
+        for d, day in docs.groupby(docs['time'].dt.date):
+            file = self.path / f'{d.isoformat()}.parquet'
+            if file.exists():
+                day = pd.concat([pd.read_parquet(file), day], ignore_index=True)
+                day = day.drop_duplicates(subset='word', keep='last')
+                # keys written by older versions are folded again
+                day['key'] = casefold(day['word'])
+
+            day.to_parquet(file, index=False)
+            logger.info(f'{file}: {day.shape[0]} n-grams')
+
+
+class CachedBackend:
+    """Backend to serve repeated queries from a local cache of query results
+
+    Results are cached by calendar month: months that ended before the TTL window
+    are immutable and kept until evicted, recent months expire after the TTL
+    """
+
+    def __init__(self, backend, cache, db, lang, source=None):
+        """Wrap a backend with a cache
+
+        Args:
+            backend: a backend object to fetch missing results from
+            cache (cache.QueryCache): cache of query results
+            db: database to use
+            lang: language collection to use
+            source (string): name of the data source (e.g. path to a local store), part of every cache key
+        """
+        self.backend = backend
+        self.cache = cache
+        self.db = db
+        self.lang = lang
+        self.source = source if source is not None else type(backend).__name__
+
+    def find(self, word_list, start_time=None, fields=None, case_insensitive=False, end_time=None):
+        """Fetch daily documents for a list of n-grams
+
+        Args:
+            word_list (list): list of strings to query
+            start_time (datetime): starting date for query
+            fields (list): list of fields to fetch in addition to `word` and `time` (defaults to all)
+            case_insensitive (bool): a toggle to match n-grams regardless of capitalization
+            end_time (datetime): ending date for query (exclusive)
+
+        Returns (pd.DataFrame):
+            dataframe of raw documents with the database field names
+        """
+        columns = projection(fields)
+        start = start_time if start_time else datetime.datetime(2019, 9, 1)
+        end = end_time if end_time else datetime.datetime.today()
+        months = pd.period_range(start, end - datetime.timedelta(microseconds=1), freq='M')
+
+        keys = {
+            m: self.cache.key(
+                source=self.source,
+                db=self.db,
+                lang=self.lang,
+                words=sorted(set(word_list)),
+                fields=columns,
+                case_insensitive=case_insensitive,
+                month=str(m),
+            )
+            for m in months
+        }
+
+        parts, missing = {}, []
+        for m in months:
+            parts[m] = self.cache.get(keys[m], immutable=self.cache.immutable(m.end_time))
+            if parts[m] is None:
+                missing.append(m)
+
+        if missing:
+            docs = self.backend.find(
+                word_list,
+                start_time=missing[0].start_time.to_pydatetime(),
+                end_time=(missing[-1] + 1).start_time.to_pydatetime(),
+                fields=fields,
+                case_insensitive=case_insensitive,
+            )
+            docs['time'] = pd.to_datetime(docs['time'])
+            by_month = docs['time'].dt.to_period('M')
+
+            for m in missing:
+                parts[m] = docs[by_month == m].reset_index(drop=True)
+                self.cache.put(keys[m], parts[m])
+            self.cache.flush()
+
+        # months without documents are cached as empty frames without columns
+        frames = [parts[m] for m in months if not parts[m].empty]
+        if not frames:
+            frames = [pd.DataFrame(columns=columns).astype({'time': 'datetime64[ns]'})]
+
+        df = pd.concat(frames, ignore_index=True)
+        df = df[df['time'] >= pd.Timestamp(start)]
+        if end_time:
+            df = df[df['time'] < pd.Timestamp(end_time)]
+        return df.reset_index(drop=True)
+
+    def iter_daily(self, word_list, start_time=None, fields=None, batch_size=50000, case_insensitive=False):
+        """Stream daily documents for a list of n-grams (not cached)
+
+        Args:
+            word_list (list): list of strings to query
+            start_time (datetime): starting date for query
+            fields (list): list of fields to fetch in addition to `word` and `time` (defaults to all)
+            batch_size (int): approximate number of documents per batch
+            case_insensitive (bool): a toggle to match n-grams regardless of capitalization
+
+        Yields (pd.DataFrame):
+            batches of raw documents with the database field names (`word` is categorical)
+        """
+        yield from self.backend.iter_daily(
+            word_list,
+            start_time=start_time,
+            fields=fields,
+            batch_size=batch_size,
+            case_insensitive=case_insensitive,
+        )
+
+
+def get_backend(db, lang, username='guest', pwd='roboctopus', store=None, cache=None, case_index=None):
+    """Pick a backend to serve a language collection
+
+    Args:
+        db: database to use
+        lang: language collection to use
+        username: username to access database
+        pwd: password to access database
+        store (pathlib.Path): path to a local store (defaults to the MongoDB server)
+        cache (cache.QueryCache): cache of query results
+        case_index (pathlib.Path): path to a local directory of case-folded lookups
+
+    Returns:
+        a backend object with `find` and `iter_daily` methods
+    """
+    if store is not None:
+        backend = ParquetBackend(db, lang, store)
+    else:
+        backend = MongoBackend(db, lang, username=username, pwd=pwd, case_index=case_index)
+
+    if cache is not None:
+        source = f'parquet:{Path(store).resolve()}' if store is not None else 'mongodb'
+        return CachedBackend(backend, cache, db, lang, source=source)
+    return backend
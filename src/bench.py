@@ -0,0 +1,334 @@
+import sys
+import json
+import time
+import shutil
+import platform
+import datetime
+import tempfile
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from argparse import ArgumentDefaultsHelpFormatter
+
+import derived
+from query import Query
+from backends import projection, casefold
+from rules import RuleSet
+from timeseries import TimeseriesStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+tokens = [
+    'virus', 'Virus', 'pandemic', 'lockdown', 'RT', '@user', '&amp;', 'covid-19', '#stayhome', '😷',
+    'https://t.co/x', 'quarantäne', 'карантин', 'كورونا', '코로나', 'हिन्दी', 'தமிழ்', 'masks', 'cases', '2020',
+]
+
+
+def synthetic_ngrams(n, seed=42):
+    """Generate a list of unique n-grams
+
+    Args:
+        n (int): number of n-grams
+        seed (int): seed for the random generator
+
+    Returns (list):
+        list of n-grams
+    """
+    rng = np.random.default_rng(seed)
+    words = rng.choice(tokens, size=(n, 2))
+    return [f'{a} {b}{i}' if i % 3 == 0 else f'{a}{i}' for i, (a, b) in enumerate(words)]
+
+
+def synthetic_docs(words, start_date, days, density=.9, seed=42):
+    """Generate daily documents following the schema of the n-gram database
+
+    Args:
+        words (list): list of n-grams
+        start_date (datetime): first day
+        days (int): number of days
+        density (float): fraction of (day, n-gram) pairs with a document
+        seed (int): seed for the random generator
+
+    Returns (pd.DataFrame):
+        dataframe of raw documents with the database field names
+    """
+    rng = np.random.default_rng(seed)
+    t, w = np.divmod(np.arange(days * len(words)), len(words))
+    keep = rng.random(t.size) < density
+    t, w = t[keep], w[keep]
+
+    counts = rng.zipf(1.5, size=t.size).clip(max=10 ** 7)
+    count_no_rt = (counts * rng.random(t.size)).astype(int)
+    return pd.DataFrame({
+        'word': pd.Categorical.from_codes(w, categories=words),
+        'time': np.datetime64(start_date, 'D') + t.astype('timedelta64[D]'),
+        'counts': counts,
+        'count_noRT': count_no_rt,
+        'rank': (w + 1).astype(float),
+        'rank_noRT': (w + 1).astype(float),
+        'freq': counts / 10 ** 8,
+        'freq_noRT': count_no_rt / 10 ** 8,
+    })
+
+
+class MemoryBackend:
+    """Backend to serve n-gram documents from memory"""
+
+    def __init__(self, docs):
+        """Serve a dataframe of documents
+
+        Args:
+            docs (pd.DataFrame): dataframe of raw documents with the database field names
+        """
+        self.docs = docs
+        self.lang = 'en'
+
+    def select(self, word_list, start_time=None, case_insensitive=False):
+        """Select documents for a list of n-grams"""
+        docs = self.docs
+        if start_time:
+            docs = docs[docs['time'] >= pd.Timestamp(start_time)]
+        if case_insensitive:
+            keys = {casefold(w) for w in word_list}
+            return docs[casefold(docs['word']).isin(keys)]
+        return docs[docs['word'].isin(list(word_list))]
+
+    def find(self, word_list, start_time=None, fields=None, case_insensitive=False, end_time=None):
+        """Fetch daily documents for a list of n-grams (see `backends.MongoBackend.find`)"""
+        docs = self.select(word_list, start_time, case_insensitive)
+        if end_time:
+            docs = docs[docs['time'] < pd.Timestamp(end_time)]
+        docs = docs[projection(fields)].copy()
+        docs['word'] = docs['word'].astype(str)
+        return docs.reset_index(drop=True)
+
+    def iter_daily(self, word_list, start_time=None, fields=None, batch_size=50000, case_insensitive=False):
+        """Stream daily documents for a list of n-grams (see `backends.MongoBackend.iter_daily`)"""
+        docs = self.select(word_list, start_time, case_insensitive)[projection(fields)]
+        categories = None if case_insensitive else pd.Index(list(dict.fromkeys(word_list)))
+        for i in range(0, docs.shape[0], batch_size):
+            batch = docs.iloc[i:i + batch_size].copy()
+            batch['word'] = pd.Categorical(batch['word'].astype(str), categories=categories)
+            yield batch
+
+
+def measure(func, repeat=3):
+    """Time a function
+
+    Args:
+        func (callable): function to time
+        repeat (int): number of runs
+
+    Returns (list):
+        wall time of every run in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        timeit = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - timeit)
+    return times
+
+
+def bench_queries(n, years, repeat=3):
+    """Benchmark query_timeseries, query_timeseries_array, and query_timeseries_matrix
+
+    Args:
+        n (int): number of n-grams
+        years (int): length of the history in years
+        repeat (int): number of runs
+
+    Returns (dict):
+        wall times by benchmark
+    """
+    start = datetime.datetime(2019, 9, 1)
+    words = synthetic_ngrams(n)
+    docs = synthetic_docs(words, start, days=365 * years)
+    q = Query('1grams', 'en', backend=MemoryBackend(docs))
+    metrics = ['count', 'rank', 'freq']
+
+    return {
+        'query_timeseries': measure(lambda: q.query_timeseries(words[0], start_time=start), repeat),
+        'query_insensitive_timeseries': measure(lambda: q.query_insensitive_timeseries(words[0], start_time=start), repeat),
+        'query_timeseries_array': measure(lambda: q.query_timeseries_array(words, start, metrics=metrics), repeat),
+        'query_timeseries_matrix': measure(lambda: q.query_timeseries_matrix(words, start, metrics=metrics), repeat),
+    }
+
+
+def bench_merge(n, years, repeat=3, days=10):
+    """Benchmark merging the last few days into a stored (T x N) matrix and exporting it
+
+    Args:
+        n (int): number of n-grams
+        years (int): length of the history in years
+        repeat (int): number of runs
+        days (int): number of days to merge
+
+    Returns (dict):
+        wall times by benchmark
+    """
+    start = datetime.datetime(2019, 9, 1)
+    words = synthetic_ngrams(n)
+    docs = synthetic_docs(words, start, days=365 * years)
+    q = Query('1grams', 'en', backend=MemoryBackend(docs))
+    history = q.query_timeseries_matrix(words, start, metrics=['count'])['count']
+    recent = history.iloc[-days:]
+
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        ts = TimeseriesStore(tmp)
+        ts.upsert('count', history)
+        return {
+            'store_upsert': measure(lambda: ts.upsert('count', recent), repeat),
+            'store_export': measure(lambda: ts.export('count'), repeat),
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_filter(n, repeat=3):
+    """Benchmark cleaning a ranked list of n-grams
+
+    Args:
+        n (int): number of n-grams
+        repeat (int): number of runs
+
+    Returns (dict):
+        wall times by benchmark
+    """
+    ngrams = pd.Series(synthetic_ngrams(n))
+    return {
+        'filter_ngrams': measure(lambda: RuleSet().apply(ngrams), repeat),
+    }
+
+
+def bench_plot(years, repeat=1):
+    """Benchmark rendering the grid of case-counts and n-grams
+
+    Args:
+        years (int): length of the history in years
+        repeat (int): number of runs
+
+    Returns (dict):
+        wall times by benchmark
+    """
+    import vis
+    import consts
+
+    start = datetime.datetime(2020, 1, 1)
+    index = pd.date_range(start, periods=365 * years, freq='D')
+    rng = np.random.default_rng(42)
+
+    ngrams = {}
+    for c, words in consts.words_by_country.items():
+        ngrams[c] = []
+        for w, lang in words:
+            d = pd.DataFrame({'rank': rng.integers(1, 10 ** 5, size=index.size).astype(float)}, index=index)
+            d.index.name = f"{lang}\n'{w}'"
+            ngrams[c].append(d)
+
+    cases = pd.DataFrame(
+        rng.integers(0, 10 ** 5, size=(index.size, len(consts.words_by_country))),
+        index=index,
+        columns=list(consts.words_by_country.keys())
+    )
+    layers = {k: derived.smooth(v) for k, v in derived.cases_series(ngrams, cases, cases).items()}
+
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        return {
+            'derive_cases': measure(
+                lambda: derived.DerivedSeries(tmp / 'derived').update_all(derived.cases_series(ngrams, cases, cases)),
+                repeat
+            ),
+            'plot_cases': measure(lambda: vis.plot_cases(tmp / 'cases', **layers), repeat),
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_startup(repeat=3):
+    """Benchmark starting a fresh interpreter up to the first query of an update
+
+    Args:
+        repeat (int): number of runs
+
+    Returns (dict):
+        wall times by benchmark
+    """
+    src = Path(__file__).resolve().parent
+    probe = (
+        "import sys, update; "
+        "heavy = [m for m in ('matplotlib', 'pymongo', 'contagiograms') if m in sys.modules]; "
+        "sys.exit(f'loaded: {heavy}' if heavy else 0)"
+    )
+
+    def start(code):
+        subprocess.run([sys.executable, '-c', code], cwd=src, check=True)
+
+    return {
+        'startup_python': measure(lambda: start('pass'), repeat),
+        'startup_update': measure(lambda: start(probe), repeat),
+    }
+
+
+def parse_args(args):
+    """ Util function to parse command-line arguments """
+    parser = argparse.ArgumentParser(
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description='Benchmarks for the startup, query, pivot, merge, and filter hot paths'
+    )
+    parser.add_argument('--ngrams', nargs='+', type=int, default=[100, 1000, 10000], help='numbers of n-grams')
+    parser.add_argument('--years', nargs='+', type=int, default=[1, 2, 5], help='lengths of the history in years')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs for every benchmark')
+    parser.add_argument('--skip-plot', action='store_true', help='skip rendering benchmarks')
+    parser.add_argument('--output', default='bench.json', help='path to save results')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    results = []
+
+    def record(times, **params):
+        for name, t in times.items():
+            results.append({'benchmark': name, **params, 'times': t, 'min': min(t), 'mean': float(np.mean(t))})
+            logger.info(f"{name} {params}: {min(t):.4f} sec.")
+
+    record(bench_startup(repeat=args.repeat), ngrams=None, years=None)
+
+    for n in args.ngrams:
+        record(bench_filter(n * 100, repeat=args.repeat), ngrams=n * 100, years=None)
+
+        for y in args.years:
+            record(bench_queries(n, y, repeat=args.repeat), ngrams=n, years=y)
+            record(bench_merge(n, y, repeat=args.repeat), ngrams=n, years=y)
+
+    if not args.skip_plot:
+        for y in args.years:
+            record(bench_plot(y), ngrams=None, years=y)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.platform(),
+            'results': results,
+        }, f, indent=2)
+
+    logger.info(f'Saved: {args.output}')
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+import pandas as pd
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class QueryCache:
+    """Class to keep query results on disk
+
+    Entries are Parquet files named after a hash of the normalized query,
+    and evicted in least-recently-used order once the cache grows past its size cap;
+    queries without results are only listed in `{path}/empty.json`
+    """
+
+    def __init__(self, path, ttl=6, settle=3, max_size=2 * 1024 ** 3):
+        """Open a cache directory
+
+        Args:
+            path (pathlib.Path): path to the cache directory
+            ttl (int): number of hours to keep results that include recent days
+            settle (int): number of days after which the data of a day no longer changes
+            max_size (int): maximum size of the cache in bytes
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+        self.settle = settle
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # running size of the entries (the directory is only scanned once)
+        self.size = None
+
+        self.empty = {}
+        self.dirty = False
+        if (self.path / 'empty.json').exists():
+            with open(self.path / 'empty.json') as f:
+                self.empty = json.load(f)
+
+    @staticmethod
+    def key(**query):
+        """Hash a normalized query
+
+        Args:
+            query: parameters of the query
+
+        Returns (string):
+            hex digest of the query
+        """
+        return hashlib.sha256(json.dumps(query, sort_keys=True, ensure_ascii=False).encode('utf8')).hexdigest()
+
+    def immutable(self, last_day):
+        """Check if results up to a given day are final
+
+        Args:
+            last_day (datetime): last day covered by the results
+
+        Returns (bool):
+            True if results can be cached forever
+        """
+        return last_day < pd.Timestamp(datetime.date.today() - datetime.timedelta(self.settle))
+
+    def file(self, key):
+        """Path to the entry of a query"""
+        return self.path / key[:2] / f'{key}.parquet'
+
+    def get(self, key, immutable=False):
+        """Look up results in the cache
+
+        Args:
+            key (string): hash of the query
+            immutable (bool): a toggle to ignore the TTL
+
+        Returns (pd.DataFrame):
+            cached results or None for a miss
+        """
+        file = self.file(key)
+        with self.lock:
+            if key in self.empty and (immutable or time.time() - self.empty[key] < self.ttl * 3600):
+                self.hits += 1
+                return pd.DataFrame()
+
+            if file.exists() and (immutable or time.time() - file.stat().st_mtime < self.ttl * 3600):
+                try:
+                    df = pd.read_parquet(file)
+                except Exception as e:
+                    # entries left unreadable by older versions are dropped
+                    logger.warning(f'Dropping unreadable cache entry: {file} ({e})')
+                    self.size = None
+                    file.unlink(missing_ok=True)
+                else:
+                    self.hits += 1
+                    os.utime(file, (time.time(), file.stat().st_mtime))
+                    return df
+
+            self.misses += 1
+            return None
+
+    def put(self, key, df):
+        """Store results in the cache
+
+        Empty results are listed in the index of empty queries (see `flush`)
+
+        Args:
+            key (string): hash of the query
+            df (pd.DataFrame): results to store
+        """
+        with self.lock:
+            if df.empty:
+                self.empty[key] = time.time()
+                self.dirty = True
+                return
+
+            if self.size is None:
+                self.size = sum(f.stat().st_size for f in self.path.glob('*/*.parquet'))
+
+            file = self.file(key)
+            if file.exists():
+                self.size -= file.stat().st_size
+
+            file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = file.with_suffix('.tmp')
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, file)
+            self.size += file.stat().st_size
+
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self, headroom=0.9):
+        """Remove least recently used entries until the cache fits in its size cap
+
+        Args:
+            headroom (float): fraction of the size cap to shrink the cache to
+        """
+        files = [(f.stat().st_atime, f.stat().st_size, f) for f in self.path.glob('*/*.parquet')]
+        self.size = sum(s for a, s, f in files)
+
+        for a, s, f in sorted(files):
+            if self.size <= self.max_size * headroom:
+                break
+            f.unlink()
+            self.size -= s
+
+    def flush(self):
+        """Save the index of empty queries"""
+        with self.lock:
+            if not self.dirty:
+                return
+
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp = self.path / 'empty.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.empty, f)
+            os.replace(tmp, self.path / 'empty.json')
+            self.dirty = False
+
+    def stats(self):
+        """Summarize cache usage
+
+        Returns (dict):
+            number of hits and misses
+        """
+        return {'hits': self.hits, 'misses': self.misses}
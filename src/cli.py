@@ -18,6 +18,63 @@ def parse_args(args):
         Copyright (c) 2020 The Computational Story Lab. Licensed under the MIT License;'
     )
 
+    parser.add_argument(
+        '--store',
+        default=None,
+        help='path to a local columnar store to use instead of the database server'
+    )
+
+    parser.add_argument(
+        '--cache',
+        default=None,
+        help='path to a local cache of query results for figures (defaults to data/cache)'
+    )
+
+    parser.add_argument(
+        '--case-index',
+        default=None,
+        help='path to a local lookup of capitalizations for case-insensitive queries (defaults to data/case_index)'
+    )
+
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='number of languages and n-gram lists to update concurrently'
+    )
+
+    parser.add_argument(
+        '--retries',
+        default=2,
+        type=int,
+        help='number of times to retry a failing update'
+    )
+
+    parser.add_argument(
+        '--overlap',
+        default=2,
+        type=int,
+        help='number of days before the last complete day to fetch again for late corrections'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='skip (target, language, metric) units finished by the last run if it did not complete'
+    )
+
+    parser.add_argument(
+        '--metrics',
+        default=None,
+        help='path to append timing and resource records as JSON lines (defaults to data/metrics.jsonl)'
+    )
+
+    parser.add_argument(
+        '--profile',
+        default=None,
+        help='path to save cProfile stats of the run (only the main thread is profiled, use with --workers 1)'
+    )
+
     # optional subparsers
     subparsers = parser.add_subparsers(help='Arguments for specific action.', dest='dtype')
     subparsers.required = False
@@ -30,5 +87,64 @@ def parse_args(args):
         'jhu',
         help='absolute path to the COVID-19 data repository by Johns Hopkins University'
     )
+    ff.add_argument(
+        '--processes',
+        default=None,
+        type=int,
+        help='number of figures to render in parallel (defaults to one per figure, up to all cores)'
+    )
+    ff.add_argument(
+        '--force',
+        action='store_true',
+        help='render every figure even if its inputs have not changed'
+    )
+
+    subparsers.add_parser(
+        'export',
+        help='export stored timeseries to TSV files'
+    )
+
+    mm = subparsers.add_parser(
+        'mirror',
+        help='copy requested n-grams from the database server to a local store'
+    )
+    mm.add_argument(
+        'store',
+        help='path to the local columnar store'
+    )
+
+    rr = subparsers.add_parser(
+        'rtd',
+        help='rank n-grams by their contribution to the rank-turbulence divergence of two periods'
+    )
+    rr.add_argument(
+        'reference',
+        help='path to the n-gram counts of the reference period (Parquet or TSV)'
+    )
+    rr.add_argument(
+        'current',
+        help='path to the n-gram counts of the current period (Parquet or TSV)'
+    )
+    rr.add_argument(
+        'savepath',
+        help='path to save the ranked list of n-grams (e.g. data/rank_turbulence_divergence/raw/april_top_1grams/en_top_1grams.tsv)'
+    )
+    rr.add_argument(
+        '--alpha',
+        default=1/3,
+        type=float,
+        help='turbulence parameter'
+    )
+    rr.add_argument(
+        '--topk',
+        default=10000,
+        type=int,
+        help='number of n-grams to keep'
+    )
+    rr.add_argument(
+        '--all',
+        action='store_true',
+        help='keep n-grams used less in the current period as well'
+    )
 
     return parser.parse_args(args)
@@ -1,13 +1,66 @@
+import os
+import json
+from pathlib import Path
 
-import matplotlib.font_manager as fm
-fm._rebuild()
-noto = [f.name for f in fm.fontManager.ttflist if 'Noto Sans' in f.name]
+# fonts are resolved on first use (see `noto_fonts`), so importing this module stays cheap
+font_cache = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'covid19ngrams' / 'noto.json'
+
+
+def noto_fonts(refresh=False):
+    """List installed Noto Sans fonts
+
+    The lookup is cached on disk for the installed version of matplotlib,
+    so the font list is only scanned once
+
+    Args:
+        refresh (bool): a toggle to scan the font list again (e.g. after installing new fonts)
+
+    Returns (list):
+        names of Noto Sans fonts known to matplotlib
+    """
+    from importlib.metadata import version
+    key = version('matplotlib')
+    if not refresh and font_cache.exists():
+        with open(font_cache) as f:
+            cached = json.load(f)
+        if cached.get('matplotlib') == key:
+            return cached['noto']
+
+    import matplotlib.font_manager as fm
+    noto = sorted({f.name for f in fm.fontManager.ttflist if 'Noto Sans' in f.name})
+
+    font_cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp = font_cache.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'matplotlib': key, 'noto': noto}, f)
+    os.replace(tmp, font_cache)
+    return noto
+
+
+def font_properties():
+    """Font properties by script
+
+    Returns (dict):
+        a dictionary of `matplotlib.font_manager.FontProperties`
+    """
+    import matplotlib.font_manager as fm
+    return {
+        'Default': fm.FontProperties(family=["sans-serif"]),
+        'Korean': fm.FontProperties(family=["Noto Sans CJK KR", "Noto Sans CJK", "sans-serif"]),
+        'Tamil': fm.FontProperties(family=["Noto Sans Tamil", "sans-serif"]),
+    }
+
+
+def __getattr__(name):
+    """Resolve `noto` and `fonts` lazily"""
+    if name == 'noto':
+        globals()['noto'] = noto_fonts()
+    elif name == 'fonts':
+        globals()['fonts'] = font_properties()
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return globals()[name]
 
-fonts = {
-    'Default': fm.FontProperties(family=["sans-serif"]),
-    'Korean': fm.FontProperties(family=["Noto Sans CJK KR", "Noto Sans CJK", "sans-serif"]),
-    'Tamil': fm.FontProperties(family=["Noto Sans Tamil", "sans-serif"]),
-}
 
 at_color = 'k'
 ot_color = 'C0'
@@ -7,7 +7,8 @@ jhu="$HOME/www-root/share/data/COVID-19"
 
 
 # update n-grams timeseries
-/usr/bin/time -v -o $repo/data/resources.txt ~/anaconda3/envs/storywrangler/bin/python $script &> $log
+/usr/bin/time -v -o $repo/data/resources.txt ~/anaconda3/envs/storywrangler/bin/python $script --workers 8 &> $log
+~/anaconda3/envs/storywrangler/bin/python $script export &>> $log
 
 
 # udpate figures for https://arxiv.org/abs/2003.12614
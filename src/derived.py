@@ -0,0 +1,146 @@
+import os
+import pandas as pd
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def smooth(df, window=7):
+    """Smooth daily series with a centered rolling average
+
+    Args:
+        df (pd.DataFrame): (T x N) dataframe of daily series
+        window (int): number of days to average
+
+    Returns (pd.DataFrame):
+        (T x N) dataframe of smoothed series
+    """
+    return df.rolling(window, center=True).mean()
+
+
+def cases_series(ngrams, deaths, confirmed, max_rank=10 ** 5):
+    """Collect the daily series plotted in the grid of case-counts and ngrams
+
+    The last two (incomplete) days of every n-gram are left out,
+    and days an n-gram is missing from the database are set to `max_rank`
+
+    Args:
+        ngrams (dict): a dictionary of ngrams by country
+        deaths (pd.DataFrame): a dataframe of new deaths by country
+        confirmed (pd.DataFrame): a dataframe of new cases by country
+        max_rank (int): rank of n-grams missing from the database
+
+    Returns (dict):
+        (T x N) dataframes of n-gram ranks (columns keyed by country and n-gram),
+        average ranks, deaths, and cases by country
+    """
+    ranks = {}
+    for country, frames in ngrams.items():
+        df = pd.DataFrame({d.index.name: d['rank'].iloc[:-2] for d in frames})
+        df.index = pd.to_datetime(df.index)
+        ranks[country] = df.fillna(max_rank)
+
+    return {
+        'ranks': pd.concat(ranks, axis=1),
+        'average': pd.DataFrame({c: df.mean(axis=1) for c, df in ranks.items()}),
+        'deaths': deaths,
+        'confirmed': confirmed,
+    }
+
+
+class DerivedSeries:
+    """Class to keep smoothed series ready for plotting
+
+    Every layer is kept as `{path}/{name}.parquet`, next to a hash of every row of its raw series
+    (`{path}/{name}.hashes.parquet`); only the days whose rolling window saw new or revised data
+    are computed again
+    """
+
+    def __init__(self, path, window=7):
+        """Open a directory of derived series
+
+        Args:
+            path (pathlib.Path): path to the directory of derived series
+            window (int): number of days to average
+        """
+        self.path = Path(path)
+        self.window = window
+
+    def load(self, name):
+        """Load a layer
+
+        Args:
+            name (string): name of the layer (e.g. 'ranks', 'average')
+
+        Returns (pd.DataFrame):
+            (T x N) dataframe of smoothed series or None if the layer does not exist
+        """
+        file = self.path / f'{name}.parquet'
+        return pd.read_parquet(file) if file.exists() else None
+
+    def hashes(self, name):
+        """Load the row hashes of the raw series a layer was last smoothed from
+
+        Args:
+            name (string): name of the layer
+
+        Returns (pd.Series):
+            hash of every raw row indexed by date or None if unknown
+        """
+        file = self.path / f'{name}.hashes.parquet'
+        return pd.read_parquet(file)['hash'] if file.exists() else None
+
+    def update(self, name, raw):
+        """Smooth new or revised days of a layer
+
+        Days whose rolling window saw no changed raw value are kept as they are,
+        unless the set of series changed
+
+        Args:
+            name (string): name of the layer
+            raw (pd.DataFrame): (T x N) dataframe of daily series
+
+        Returns (pd.DataFrame):
+            (T x N) dataframe of smoothed series
+        """
+        old = self.load(name)
+        if old is not None:
+            # Parquet may read dates back at another resolution, which would change fingerprints
+            old.index = old.index.as_unit(raw.index.unit)
+        stored = self.hashes(name)
+        hashes = pd.util.hash_pandas_object(raw, index=True)
+
+        if old is not None and not old.empty and stored is not None and old.columns.equals(raw.columns):
+            changed = raw.index[hashes.ne(stored.reindex(raw.index))].union(stored.index.difference(raw.index))
+            if changed.empty:
+                return old
+
+            # the first day whose (centered) window reaches a changed row
+            cutoff = changed.min() - pd.Timedelta(days=self.window)
+            fresh = smooth(raw[raw.index > cutoff - pd.Timedelta(days=self.window)], self.window)
+            df = pd.concat([old[old.index <= cutoff], fresh[fresh.index > cutoff]])
+        else:
+            logger.info(f'Computing: {name}')
+            df = smooth(raw, self.window)
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        for out, frame in [
+            (self.path / f'{name}.parquet', df),
+            (self.path / f'{name}.hashes.parquet', hashes.rename('hash').to_frame()),
+        ]:
+            tmp = out.with_suffix('.tmp')
+            frame.to_parquet(tmp)
+            os.replace(tmp, out)
+        return df
+
+    def update_all(self, series):
+        """Smooth new or revised days of several layers
+
+        Args:
+            series (dict): (T x N) dataframes of daily series keyed by layer name
+
+        Returns (dict):
+            (T x N) dataframes of smoothed series keyed by layer name
+        """
+        return {name: self.update(name, raw) for name, raw in series.items()}
@@ -3,6 +3,8 @@ import sys
 import time
 from pathlib import Path
 
+import pandas as pd
+
 import utils
 
 
@@ -15,12 +17,19 @@ def main():
 
     Path(outdir).mkdir(parents=True, exist_ok=True)
 
-    for f in targets.glob('*grams'):
+    reports = [
         utils.filter_ngrams(
             save_path=outdir / f.stem,
             ngrams_path=targets / f.stem,
             languages_path=langs,
         )
+        for f in targets.glob('*grams')
+    ]
+
+    report = pd.concat(reports).groupby(level=0, sort=False).sum()
+    report.index.name = 'rule'
+    report.to_csv(outdir / 'rules.tsv', sep='\t')
+    print(report)
 
     print(f'Total time elapsed: {time.time() - timeit:.2f} sec.')
 
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*inputs):
+    """Hash the inputs of a figure
+
+    Args:
+        inputs: dataframes, series, file paths, or JSON-serializable parameters
+            (dictionaries and lists are walked recursively)
+
+    Returns (string):
+        hex digest of the inputs
+    """
+    h = hashlib.sha256()
+
+    def update(obj):
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            labels = list(obj.columns) if isinstance(obj, pd.DataFrame) else [obj.name]
+            h.update(repr((obj.shape, labels)).encode('utf8'))
+            h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+        elif isinstance(obj, Path):
+            stat = obj.stat()
+            h.update(f'{obj}|{stat.st_size}|{stat.st_mtime_ns}|'.encode('utf8'))
+            with open(obj, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        elif isinstance(obj, dict):
+            for k in sorted(obj, key=str):
+                h.update(f'{k}:'.encode('utf8'))
+                update(obj[k])
+        elif isinstance(obj, (list, tuple)):
+            h.update(f'[{len(obj)}'.encode('utf8'))
+            for o in obj:
+                update(o)
+        else:
+            h.update(json.dumps(obj, default=str, ensure_ascii=False).encode('utf8'))
+
+    for i in inputs:
+        update(i)
+    return h.hexdigest()
+
+
+class Fingerprints:
+    """Class to keep track of the inputs every figure was last rendered from
+
+    Fingerprints are kept in a small JSON file keyed by figure name
+    """
+
+    def __init__(self, path):
+        """Open a file of fingerprints
+
+        Args:
+            path (pathlib.Path): path to the JSON file
+        """
+        self.path = Path(path)
+        self.marks = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.marks = json.load(f)
+
+    def changed(self, name, digest, outputs=()):
+        """Check if a figure needs to be rendered again
+
+        Args:
+            name (string): name of the figure
+            digest (string): fingerprint of its current inputs
+            outputs (list): files the figure is saved to
+
+        Returns (bool):
+            True if the inputs changed or an output is missing
+        """
+        return self.marks.get(name) != digest or not all(Path(o).exists() for o in outputs)
+
+    def set(self, name, digest):
+        """Record the inputs a figure was rendered from
+
+        Args:
+            name (string): name of the figure
+            digest (string): fingerprint of its inputs
+        """
+        self.marks[name] = digest
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(dict(sorted(self.marks.items())), f, indent=2)
+        os.replace(tmp, self.path)
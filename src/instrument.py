@@ -0,0 +1,146 @@
+import sys
+import json
+import time
+import cProfile
+import datetime
+import resource
+import threading
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+tags = contextvars.ContextVar('tags', default={})
+
+
+class Recorder:
+    """Class to append timing and resource records to a file of JSON lines
+
+    Every record carries the tags of the enclosing contexts
+    (e.g. database, lang, target), so stages can be grouped after the fact
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, path=None):
+        """Open a file of records
+
+        Args:
+            path (pathlib.Path): path to the JSON lines file (records are dropped if None)
+        """
+        self.path = Path(path) if path else None
+
+    def write(self, record):
+        """Append a record
+
+        Args:
+            record (dict): a JSON-serializable record
+        """
+        if self.path is None:
+            return
+
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+recorder = Recorder()
+
+
+def configure(path):
+    """Start recording to a file
+
+    Args:
+        path (pathlib.Path): path to the JSON lines file (None to stop recording)
+    """
+    recorder.path = Path(path) if path else None
+    if recorder.path:
+        logger.info(f'Recording metrics: {recorder.path}')
+
+
+def peak_rss():
+    """Get the peak resident set size of the process
+
+    Returns (int):
+        peak RSS in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def emit(name, **fields):
+    """Record an event with the tags of the enclosing contexts
+
+    Args:
+        name (string): name of the stage
+        **fields: values to record
+    """
+    recorder.write({
+        'timestamp': datetime.datetime.now().isoformat(timespec='milliseconds'),
+        'stage': name,
+        **tags.get(),
+        **fields,
+        'peak_rss': peak_rss(),
+    })
+
+
+@contextmanager
+def context(**kwargs):
+    """Tag every record emitted within the block
+
+    Args:
+        **kwargs: tags to add (e.g. database='1grams', lang='en')
+    """
+    token = tags.set({**tags.get(), **kwargs})
+    try:
+        yield
+    finally:
+        tags.reset(token)
+
+
+@contextmanager
+def stage(name, **fields):
+    """Time a block and record it as a stage
+
+    The block can add its own values (e.g. documents fetched) to the yielded dict
+
+    Args:
+        name (string): name of the stage
+        **fields: values to record
+
+    Yields (dict):
+        values to record once the block exits
+    """
+    timeit = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        fields['error'] = repr(e)
+        raise
+    finally:
+        emit(name, seconds=time.perf_counter() - timeit, **fields)
+
+
+@contextmanager
+def profile(path=None):
+    """Profile a block with cProfile
+
+    Args:
+        path (pathlib.Path): path to save stats for `pstats` or `snakeviz` (the block runs as is if None)
+    """
+    if path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logger.info(f'Saved profile: {path}')
@@ -0,0 +1,148 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+date_format = '%m/%d/%y'
+
+
+def date_columns(file):
+    """List the date columns of a JHU time series
+
+    Args:
+        file (pathlib.Path): path to a JHU CSV file
+
+    Returns (list):
+        names of the date columns in file order
+    """
+    header = pd.read_csv(file, nrows=0).columns
+    dates = pd.to_datetime(header, format=date_format, errors='coerce')
+    return list(header[dates.notna()])
+
+
+def read_counts(file, by, columns=None):
+    """Read cumulative counts summed up by region
+
+    Only the grouping column and the requested date columns are parsed
+
+    Args:
+        file (pathlib.Path): path to a JHU CSV file
+        by (string): column to group rows by (e.g. 'Country/Region')
+        columns (list): date columns to read (defaults to all)
+
+    Returns (pd.DataFrame):
+        (T x C) dataframe of cumulative counts indexed by date
+    """
+    columns = date_columns(file) if columns is None else list(columns)
+    df = pd.read_csv(
+        file,
+        header=0,
+        usecols=[by] + columns,
+        dtype={by: 'string', **{c: 'float64' for c in columns}},
+    )
+    df = df.groupby(by, sort=True)[columns].sum().T
+    df.index = pd.to_datetime(df.index, format=date_format)
+    df.columns = df.columns.astype(str)
+    df.columns.name = None
+    return df
+
+
+class CaseCounts:
+    """Class to keep columnar copies of the JHU time series
+
+    Every CSV file is summed up by region and kept as `{path}/{file.stem}.parquet`,
+    which is only rebuilt from the days the source gained (plus a few recent ones)
+    when the file changes; the whole file is imported again if those recent days were revised
+    """
+
+    def __init__(self, path, overlap=7):
+        """Open a directory of cached counts
+
+        Args:
+            path (pathlib.Path): path to the cache directory
+            overlap (int): number of cached days to read again for late corrections
+        """
+        self.path = Path(path)
+        self.overlap = overlap
+
+    def load(self, file, by):
+        """Load cumulative counts summed up by region
+
+        Args:
+            file (pathlib.Path): path to a JHU CSV file
+            by (string): column to group rows by (e.g. 'Country/Region')
+
+        Returns (pd.DataFrame):
+            (T x C) dataframe of cumulative counts indexed by date
+        """
+        file = Path(file)
+        out = self.path / f'{file.stem}.parquet'
+        meta = self.path / f'{file.stem}.json'
+
+        stat = file.stat()
+        source = dict(file=str(file.resolve()), by=by, size=stat.st_size, mtime=stat.st_mtime_ns)
+        cached = None
+        if out.exists() and meta.exists():
+            with open(meta) as f:
+                if json.load(f) == source:
+                    return pd.read_parquet(out)
+            cached = pd.read_parquet(out)
+
+        columns = date_columns(file)
+        dates = pd.to_datetime(columns, format=date_format)
+
+        df = None
+        if cached is not None and not cached.empty and cached.index.isin(dates).all():
+            cutoff = cached.index.max() - pd.Timedelta(days=self.overlap)
+            fresh = read_counts(file, by, [c for c, d in zip(columns, dates) if d > cutoff])
+
+            # revised overlap days hint at revisions further back, which are only caught by a full import
+            kept = cached[cached.index > cutoff]
+            if list(fresh.columns) == list(cached.columns) and np.array_equal(
+                    fresh.reindex(kept.index).values, kept.values, equal_nan=True
+            ):
+                logger.info(f'Updating: {file.name} ({fresh.shape[0] - kept.shape[0]} new days)')
+                df = pd.concat([cached[cached.index <= cutoff], fresh])
+            else:
+                logger.info(f'Revised: {file.name} changed within the last {self.overlap} cached days')
+
+        if df is None:
+            logger.info(f'Importing: {file.name}')
+            df = read_counts(file, by, columns)
+
+        df = df.sort_index()
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = self.path / f'{file.stem}.parquet.tmp'
+        df.to_parquet(tmp)
+        os.replace(tmp, out)
+
+        tmp = meta.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(source, f, indent=2)
+        os.replace(tmp, meta)
+        return df
+
+
+def new_counts(file, us_file, counts=None):
+    """Load daily new counts by country
+
+    The United States are summed up from the county-level file
+
+    Args:
+        file (pathlib.Path): path to the global JHU CSV file
+        us_file (pathlib.Path): path to the US JHU CSV file
+        counts (CaseCounts): columnar copies to use instead of parsing the CSV files
+
+    Returns (pd.DataFrame):
+        (T x C) dataframe of new counts indexed by date
+    """
+    load = counts.load if counts is not None else read_counts
+
+    df = load(file, 'Country/Region').copy()
+    df['United States'] = load(us_file, 'Country_Region').sum(axis=1)
+    return df.diff(periods=1)
@@ -0,0 +1,144 @@
+import csv
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyarrow.csv as pacsv
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def read_counts(file):
+    """Read a distribution of n-gram counts
+
+    Parquet files need `ngram` and `count` columns,
+    anything else is parsed as a headerless TSV file of (ngram, count) rows;
+    every n-gram is expected once
+
+    Args:
+        file (pathlib.Path): path to a distribution of counts
+
+    Returns (tuple):
+        (pa.Array of n-grams as large strings, np.array of counts)
+    """
+    file = Path(file)
+    if file.suffix == '.parquet':
+        table = pq.read_table(file, columns=['ngram', 'count'])
+    else:
+        table = pacsv.read_csv(
+            file,
+            read_options=pacsv.ReadOptions(column_names=['ngram', 'count']),
+            parse_options=pacsv.ParseOptions(delimiter='\t', quote_char=False),
+            convert_options=pacsv.ConvertOptions(
+                column_types={'ngram': pa.string(), 'count': pa.float64()},
+                strings_can_be_null=False,
+            ),
+        )
+
+    table = table.filter(pc.greater(table['count'], 0))
+
+    # Parquet files written by pandas hold large strings, so both formats are read as such
+    ngrams = table['ngram'].cast(pa.large_string()).combine_chunks()
+    return ngrams, table['count'].to_numpy().astype(float)
+
+
+def tied_ranks(counts):
+    """Rank types by count, averaging the ranks of ties
+
+    Args:
+        counts (np.array): counts of every type
+
+    Returns (np.array):
+        rank of every type (1 for the most common)
+    """
+    order = np.argsort(-counts, kind='stable')
+    ordered = counts[order]
+
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    ends = np.r_[starts[1:], ordered.size]
+
+    ranks = np.empty(counts.size)
+    ranks[order] = np.repeat((starts + 1 + ends) / 2, ends - starts)
+    return ranks
+
+
+def divergence(ngrams1, counts1, ngrams2, counts2, alpha=1/3):
+    """Compute the contribution of every n-gram to the rank-turbulence divergence of two systems
+
+    Types missing from a system share its last rank, `N + (M + 1) / 2` for `M` missing types,
+    and the divergence is normalized by that of two disjoint systems of the same sizes
+    (see https://arxiv.org/abs/2002.09770)
+
+    Args:
+        ngrams1 (pa.Array): n-grams of the reference system (e.g. April 2019)
+        counts1 (np.array): counts of the reference system
+        ngrams2 (pa.Array): n-grams of the current system (e.g. April 2020)
+        counts2 (np.array): counts of the current system
+        alpha (float): turbulence parameter (smaller values give more weight to rare types)
+
+    Returns (pd.DataFrame):
+        n-grams of both systems with their ranks (`rank1`, `rank2`) and contributions (`rankdiv`)
+    """
+    n1, n2 = counts1.size, counts2.size
+    r1, r2 = tied_ranks(counts1), tied_ranks(counts2)
+
+    # position of every n-gram of the current system in the reference system
+    index = pc.index_in(ngrams2, value_set=ngrams1).fill_null(-1).to_numpy()
+    shared = index >= 0
+    m1 = n1 - shared.sum()   # reference types missing from the current system
+    m2 = (~shared).sum()     # current types missing from the reference system
+
+    rank1 = np.concatenate([r1, np.full(m2, n1 + (m2 + 1) / 2)])
+    rank2 = np.full(n1 + m2, n2 + (m1 + 1) / 2)
+    rank2[index[shared]] = r2[shared]
+    rank2[n1:] = r2[~shared]
+
+    def delta(a, b):
+        return np.abs(a ** -alpha - b ** -alpha) ** (1 / (alpha + 1))
+
+    norm = (alpha + 1) / alpha * (
+        delta(r1, n2 + (n1 + 1) / 2).sum() + delta(n1 + (n2 + 1) / 2, r2).sum()
+    )
+    contributions = (alpha + 1) / alpha * delta(rank1, rank2) / norm
+
+    ngrams = pa.concat_arrays([ngrams1, ngrams2.filter(pa.array(~shared))])
+    return pd.DataFrame({
+        'ngram': ngrams.to_pandas(types_mapper=pd.ArrowDtype),
+        'rank1': rank1,
+        'rank2': rank2,
+        'rankdiv': contributions,
+    })
+
+
+def top_ngrams(reference, current, savepath, alpha=1/3, topk=10000, rising=True):
+    """Rank n-grams by their contribution to the divergence of two periods
+
+    Args:
+        reference (pathlib.Path): path to the counts of the reference period (e.g. April 2019)
+        current (pathlib.Path): path to the counts of the current period (e.g. April 2020)
+        savepath (pathlib.Path): path to save a ranked list of n-grams (e.g. `{lang}_top_1grams.tsv`)
+        alpha (float): turbulence parameter
+        topk (int): number of n-grams to keep
+        rising (bool): a toggle to only keep n-grams used more in the current period
+
+    Returns (float):
+        rank-turbulence divergence of the two periods
+    """
+    df = divergence(*read_counts(reference), *read_counts(current), alpha=alpha)
+    total = float(df.rankdiv.sum())
+    logger.info(f'Divergence: {total:.4f} ({df.shape[0]} types)')
+
+    if rising:
+        df = df[df.rank2 < df.rank1]
+
+    top = df.rankdiv.values
+    top = np.argpartition(-top, topk - 1)[:topk] if topk < top.size else np.arange(top.size)
+    df = df.iloc[top].sort_values('rankdiv', ascending=False, kind='stable')
+
+    Path(savepath).parent.mkdir(parents=True, exist_ok=True)
+    df[['ngram', 'rankdiv']].to_csv(savepath, sep='\t', header=False, index=False, quoting=csv.QUOTE_NONE)
+    logger.info(f'Saved: {savepath}')
+    return total
@@ -0,0 +1,136 @@
+import re
+import time
+import regex
+import pandas as pd
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Rule:
+    """Class to flag n-grams matching a cleaning rule"""
+
+    def __init__(self, pattern, unicode=False, ascii_pattern=None, contains=None):
+        """Compile a cleaning rule
+
+        Args:
+            pattern (string): pattern of n-grams to remove
+            unicode (bool): a toggle for patterns that need Unicode classes (`regex` syntax)
+            ascii_pattern (string): equivalent pattern for ASCII-only n-grams (`re` syntax),
+                unicode rules without one never match ASCII-only n-grams
+            contains (string): literal that every match must contain (cheap prefilter)
+        """
+        self.pattern = pattern
+        self.unicode = unicode
+        self.ascii_pattern = ascii_pattern
+        self.contains = contains
+        self.regex = regex.compile(pattern) if unicode else re.compile(pattern)
+
+    def match(self, ngrams, ascii):
+        """Flag n-grams matching the rule
+
+        Args:
+            ngrams (pd.Series): series of n-grams
+            ascii (pd.Series): boolean mask of ASCII-only n-grams
+
+        Returns (pd.Series):
+            boolean mask of n-grams to remove
+        """
+        hits = pd.Series(False, index=ngrams.index)
+
+        candidates = pd.Series(True, index=ngrams.index)
+        if self.contains is not None:
+            candidates &= ngrams.str.contains(self.contains, regex=False)
+
+        if not self.unicode:
+            hits[candidates] = ngrams[candidates].str.contains(self.pattern)
+            return hits
+
+        if self.ascii_pattern is not None:
+            fast = candidates & ascii
+            hits[fast] = ngrams[fast].str.contains(self.ascii_pattern)
+
+        slow = candidates & ~ascii
+        hits[slow] = ngrams[slow].map(self.regex.search).notna()
+        return hits
+
+
+rules = {
+    'handles': Rule(r'(?:^| )@', contains='@'),
+    'retweet': Rule(r'RT|rt'),
+    'html': Rule(r'&\S+;', contains='&'),
+    'links': Rule(
+        r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+\S+',
+        contains='http'
+    ),
+    'punctuation': Rule(r'\p{P}', unicode=True, ascii_pattern=r'[!"#%&\'()*,\-./:;?@\[\\\]_{}]'),
+    'symbols': Rule(r'\p{S}', unicode=True, ascii_pattern=r'[$+<=>^`|~]'),
+    'marks': Rule(r'\p{M}', unicode=True),
+    'separators': Rule(r'[^\P{Z} ]', unicode=True),
+    'others': Rule(r'\p{C}', unicode=True, ascii_pattern=r'[\x00-\x1f\x7f]'),
+}
+
+default_rules = list(rules.keys())
+
+rules_by_language = {
+    # vowel signs and viramas are combining marks in Indic scripts
+    'hi': [r for r in default_rules if r != 'marks'],
+    'ta': [r for r in default_rules if r != 'marks'],
+}
+
+
+class RuleSet:
+    """Class to apply a sequence of cleaning rules and keep track of what they remove"""
+
+    def __init__(self, names=None):
+        """Select cleaning rules
+
+        Args:
+            names (list): names of rules to apply in order (defaults to all rules)
+        """
+        self.names = default_rules if names is None else names
+        self.stats = {r: {'removed': 0, 'seconds': 0.} for r in self.names}
+
+    @classmethod
+    def for_language(cls, lang_code):
+        """Select cleaning rules for a language
+
+        Args:
+            lang_code (string): language code (e.g. 'en')
+
+        Returns (RuleSet):
+            rules configured for the language
+        """
+        return cls(rules_by_language.get(lang_code))
+
+    def apply(self, ngrams):
+        """Flag n-grams to keep
+
+        Every rule only looks at n-grams that passed the previous ones
+
+        Args:
+            ngrams (pd.Series): series of n-grams
+
+        Returns (pd.Series):
+            boolean mask of n-grams to keep
+        """
+        keep = pd.Series(True, index=ngrams.index)
+        ascii = ngrams.map(str.isascii).astype(bool)
+
+        for r in self.names:
+            timeit = time.time()
+            hits = rules[r].match(ngrams[keep], ascii[keep])
+            keep.loc[hits[hits].index] = False
+
+            self.stats[r]['removed'] += int(hits.sum())
+            self.stats[r]['seconds'] += time.time() - timeit
+
+        return keep
+
+    def report(self):
+        """Summarize what every rule removed
+
+        Returns (pd.DataFrame):
+            number of n-grams removed and time spent by rule
+        """
+        return pd.DataFrame.from_dict(self.stats, orient='index', columns=['removed', 'seconds'])
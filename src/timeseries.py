@@ -0,0 +1,651 @@
+import os
+import json
+import shutil
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# compact in-memory dtypes by metric (ranks are averaged over ties, so they may be half-integers)
+dtypes = {
+    'count': 'Int32',
+    'rank': 'float32',
+    'freq': 'float32',
+}
+
+
+def downcast(df, metric):
+    """Cast a (T x N) matrix to the compact dtype of its metric
+
+    Args:
+        df (pd.DataFrame): (T x N) dataframe indexed by date
+        metric (string): metric to use (e.g. 'count', 'rank_no_rt')
+
+    Returns (pd.DataFrame):
+        (T x N) dataframe of nullable int32 counts or float32 ranks and frequencies
+    """
+    dtype = dtypes.get(metric.split('_')[0])
+    if dtype is None:
+        return df
+    if dtype == 'Int32':
+        df = df.round()
+    return df.astype(dtype)
+
+
+class TimeseriesStore:
+    """Class to work with (T x N) n-gram matrices stored in monthly partitions
+
+    Every metric is kept in a directory of Parquet files,
+    one file per month: `{path}/parquet/{metric}/{YYYY-MM}.parquet`
+    """
+
+    def __init__(self, path):
+        """Open a store of timeseries for a language
+
+        Args:
+            path (pathlib.Path): path to the directory of timeseries
+        """
+        self.path = Path(path)
+
+    def partitions(self, metric):
+        """List monthly partitions of a metric
+
+        Args:
+            metric (string): metric to use (e.g. 'count', 'rank_no_rt')
+
+        Returns (list):
+            sorted list of (pd.Period, pathlib.Path) tuples
+        """
+        return sorted(
+            (pd.Period(f.stem, freq='M'), f)
+            for f in (self.path / 'parquet' / metric).glob('*.parquet')
+        )
+
+    def exists(self, metric):
+        """Check if a metric has been stored (or can be imported from a TSV file)
+
+        Args:
+            metric (string): metric to use
+
+        Returns (bool):
+            True if the metric is available
+        """
+        return bool(self.partitions(metric)) or self.importable(metric)
+
+    def importable(self, metric):
+        """Check if a metric can be imported from its published TSV file
+
+        A reset metric is never imported again: its TSV file is only kept published
+        until the next export replaces it
+
+        Args:
+            metric (string): metric to use
+
+        Returns (bool):
+            True if the TSV file exists and the metric was not reset
+        """
+        return (self.path / f'{metric}.tsv').exists() and not (self.path / 'parquet' / f'{metric}.reset').exists()
+
+    def upsert(self, metric, df):
+        """Merge new days into a metric, rewriting only the months that changed
+
+        New values take precedence over stored ones,
+        so late corrections to recent days are kept
+
+        Args:
+            metric (string): metric to use
+            df (pd.DataFrame): (T x N) dataframe indexed by date
+        """
+        self.migrate(metric)
+        self.merge(metric, df)
+
+    def merge(self, metric, df):
+        """Merge new days into the monthly partitions of a metric
+
+        Args:
+            metric (string): metric to use
+            df (pd.DataFrame): (T x N) dataframe indexed by date
+        """
+        out = self.path / 'parquet' / metric
+        out.mkdir(parents=True, exist_ok=True)
+
+        df = df[df.index.notna()]
+        for month, new in df.groupby(df.index.to_period('M')):
+            file = out / f'{month}.parquet'
+
+            if file.exists():
+                new = new.combine_first(pd.read_parquet(file))
+
+            new = new.sort_index().sort_index(axis=1)
+            new.index.name = metric
+            new.columns = new.columns.astype(str)
+
+            # months are swapped in whole, so a crash never leaves a partition half-written
+            tmp = file.with_suffix('.tmp')
+            new.to_parquet(tmp)
+            os.replace(tmp, file)
+
+    def load(self, metric, start_date=None, end_date=None, compact=False):
+        """Load a (T x N) matrix of a metric
+
+        Args:
+            metric (string): metric to use
+            start_date (datetime): first day to load
+            end_date (datetime): last day to load
+            compact (bool): a toggle to cast every partition to the compact dtype of the metric
+
+        Returns (pd.DataFrame):
+            (T x N) dataframe indexed by date
+        """
+        self.migrate(metric)
+        first = pd.Period(start_date, freq='M') if start_date else None
+        last = pd.Period(end_date, freq='M') if end_date else None
+
+        parts = [
+            pd.read_parquet(f)
+            for month, f in self.partitions(metric)
+            if (first is None or month >= first) and (last is None or month <= last)
+        ]
+        if compact:
+            parts = [downcast(p, metric) for p in parts]
+        if not parts:
+            return pd.DataFrame(index=pd.DatetimeIndex([], name=metric))
+
+        df = pd.concat(parts).sort_index(axis=1)
+        df.index.name = metric
+        return df.loc[start_date:end_date]
+
+    def last_day(self, metric):
+        """Get the last day stored for a metric
+
+        Args:
+            metric (string): metric to use
+
+        Returns (datetime.date):
+            last day stored or None if the metric is empty
+        """
+        self.migrate(metric)
+        parts = self.partitions(metric)
+        if not parts:
+            return None
+        return pd.read_parquet(parts[-1][1]).index.max().date()
+
+    def migrate(self, metric):
+        """Import a published TSV file into an empty store
+
+        Duplicated days (left by older exports) keep their last row
+
+        Args:
+            metric (string): metric to use
+        """
+        file = self.path / f'{metric}.tsv'
+        if self.partitions(metric) or not self.importable(metric):
+            return
+
+        logger.info(f'Importing: {file}')
+        df = pd.read_csv(file, header=0, index_col=0, sep='\t', na_values=[''], keep_default_na=False)
+        df.index = pd.to_datetime(df.index, format='mixed')
+        df = df[~df.index.duplicated(keep='last')]
+        self.merge(metric, df.astype(float))
+
+    def reset(self, metric):
+        """Remove every partition of a metric
+
+        Published files (TSV and npy) are left in place until the next export or pack
+        replaces them, a marker keeps the TSV file from being imported again in the meantime
+
+        Args:
+            metric (string): metric to use
+        """
+        out = self.path / 'parquet'
+        out.mkdir(parents=True, exist_ok=True)
+        (out / f'{metric}.reset').touch()
+        shutil.rmtree(out / metric, ignore_errors=True)
+        (out / f'{metric}.json').unlink(missing_ok=True)
+        logger.info(f'Reset: {self.path / metric}')
+
+    def months(self, metric):
+        """List the monthly partitions of a metric with their modification times
+
+        Args:
+            metric (string): metric to use
+
+        Returns (dict):
+            modification times (ns) keyed by month (e.g. '2020-04')
+        """
+        return {str(m): f.stat().st_mtime_ns for m, f in self.partitions(metric)}
+
+    def export(self, metric):
+        """Export a metric to the published TSV layout
+
+        Only the months rewritten since the last export are formatted again,
+        earlier rows are copied as they are from the last export
+        (byte offsets by month are kept in `{path}/parquet/{metric}.json`)
+
+        Args:
+            metric (string): metric to use
+
+        Returns (bool):
+            True if the file was written
+        """
+        self.migrate(metric)
+        file = self.path / f'{metric}.tsv'
+        index = self.path / 'parquet' / f'{metric}.json'
+        months = self.months(metric)
+        if not months and file.exists():
+            # a reset metric keeps its last export until it is filled again
+            return False
+
+        state = None
+        if index.exists() and file.exists():
+            with open(index) as f:
+                state = json.load(f)
+            if state['size'] != file.stat().st_size or not set(state['months']) <= set(months):
+                state = None
+
+        changed = sorted(m for m, t in months.items() if state is None or state['months'].get(m) != t)
+        if state is not None and not changed:
+            return False
+
+        df = self.load(metric, start_date=pd.Period(changed[0]).start_time if state else None)
+        if state is not None and not set(df.columns) <= set(state['columns']):
+            # new n-grams add a column to every row
+            state = None
+            df = self.load(metric)
+
+        columns = list(state['columns']) if state else [str(c) for c in df.columns]
+        df = df.reindex(columns=columns).astype(float)
+
+        tmp = file.with_suffix('.tmp')
+        if state is None:
+            offsets = {}
+            with open(tmp, 'wb') as f:
+                f.write(pd.DataFrame(columns=columns, index=pd.Index([], name=metric)).to_csv(sep='\t').encode('utf8'))
+        else:
+            cut = min([o for m, o in state['offsets'].items() if m >= changed[0]], default=state['size'])
+            offsets = {m: o for m, o in state['offsets'].items() if m < changed[0]}
+            shutil.copyfile(file, tmp)
+
+        with open(tmp, 'r+b') as f:
+            if state is not None:
+                f.truncate(cut)
+            f.seek(0, os.SEEK_END)
+
+            for month, rows in df.groupby(df.index.to_period('M')):
+                offsets[str(month)] = f.tell()
+                rows.index = rows.index.strftime('%Y-%m-%d')
+                f.write(rows.to_csv(sep='\t', header=False).encode('utf8'))
+            size = f.tell()
+
+        os.replace(tmp, file)
+        tmp = index.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(dict(months=months, offsets=offsets, size=size, columns=columns), f, ensure_ascii=False)
+        os.replace(tmp, index)
+        (self.path / 'parquet' / f'{metric}.reset').unlink(missing_ok=True)
+
+        logger.info(f"Exported: {file} ({'from ' + changed[0] if state else 'all months'})")
+        return True
+
+    def pack(self, metric):
+        """Export a metric to a memory-mapped (N x T) matrix for lookups by n-gram
+
+        Every n-gram is a contiguous row of daily values: `{path}/npy/{metric}.npy`,
+        next to an index of n-grams and the first day: `{path}/npy/{metric}.json`;
+        only the days of months rewritten since the last pack are read from the partitions
+
+        Args:
+            metric (string): metric to use
+
+        Returns (bool):
+            True if the matrix was written
+        """
+        out = self.path / 'npy'
+        out.mkdir(parents=True, exist_ok=True)
+        file = out / f'{metric}.npy'
+        index = out / f'{metric}.json'
+        months = self.months(metric)
+        if not months and file.exists():
+            return False
+
+        state = None
+        if index.exists() and file.exists():
+            with open(index) as f:
+                state = json.load(f)
+            if state.get('start') is None or not set(state.get('months', {})) <= set(months):
+                state = None
+
+        changed = sorted(m for m, t in months.items() if state is None or state['months'].get(m) != t)
+        if state is not None and not changed:
+            return False
+
+        if state is not None:
+            start = pd.Timestamp(state['start'])
+            first = pd.Period(changed[0]).start_time
+            tail = self.load(metric, start_date=first)
+            if first < start or tail.empty or not set(tail.columns) <= set(state['ngrams']):
+                state = None
+
+        if state is None:
+            df = self.load(metric)
+            if not df.empty:
+                df = df.reindex(pd.date_range(df.index.min(), df.index.max(), freq='D'))
+            ngrams = [str(w) for w in df.columns]
+            start = df.index.min() if not df.empty else None
+            values = np.ascontiguousarray(df.values.T, dtype=np.float64)
+        else:
+            ngrams = state['ngrams']
+            tail = tail.reindex(index=pd.date_range(first, tail.index.max(), freq='D'), columns=ngrams)
+
+            # days before the first rewritten month are copied from the last pack
+            old = np.load(file, mmap_mode='r')
+            t0 = (first - start).days
+            values = np.full((len(ngrams), t0 + tail.shape[0]), np.nan)
+            values[:, :min(t0, old.shape[1])] = old[:, :t0]
+            values[:, t0:] = tail.values.T
+            del old
+
+        tmp = out / f'{metric}.tmp.npy'
+        np.save(tmp, values)
+        os.replace(tmp, file)
+
+        tmp = out / f'{metric}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'start': start.date().isoformat() if start is not None else None,
+                'ngrams': ngrams,
+                'months': months,
+            }, f, ensure_ascii=False)
+        os.replace(tmp, index)
+        logger.info(f"Packed: {file} ({'from ' + changed[0] if state else 'all months'})")
+        return True
+
+
+class PackedMatrix:
+    """Class to look up n-gram series in a memory-mapped (N x T) matrix
+
+    Nothing but the index is read upfront; series are views into the mapped file
+    """
+
+    def __init__(self, path, metric):
+        """Open a packed metric (see `TimeseriesStore.pack`)
+
+        Args:
+            path (pathlib.Path): path to the directory of timeseries
+            metric (string): metric to use
+        """
+        path = Path(path) / 'npy'
+        with open(path / f'{metric}.json') as f:
+            index = json.load(f)
+
+        self.metric = metric
+        self.values = np.load(path / f'{metric}.npy', mmap_mode='r')
+        self.ngrams = {w: i for i, w in enumerate(index['ngrams'])}
+        self.start = pd.Timestamp(index['start']) if index['start'] else None
+
+    def __contains__(self, ngram):
+        return ngram in self.ngrams
+
+    def dates(self, start_date=None, end_date=None):
+        """Map a date window to a slice of columns
+
+        Args:
+            start_date (datetime): first day
+            end_date (datetime): last day
+
+        Returns (slice):
+            columns of the window
+        """
+        if self.start is None:
+            return slice(0, 0)
+        first = max((pd.Timestamp(start_date) - self.start).days, 0) if start_date else 0
+        last = (pd.Timestamp(end_date) - self.start).days + 1 if end_date else self.values.shape[1]
+        return slice(first, max(first, last))
+
+    def get(self, ngram, start_date=None, end_date=None):
+        """Get the daily values of an n-gram without copying them
+
+        Args:
+            ngram (string): n-gram to look up
+            start_date (datetime): first day
+            end_date (datetime): last day
+
+        Returns (np.array):
+            read-only view of daily values
+        """
+        return self.values[self.ngrams[ngram], self.dates(start_date, end_date)]
+
+    def series(self, ngrams, start_date=None, end_date=None):
+        """Get the timeseries of one or more n-grams
+
+        Args:
+            ngrams (string or list): n-gram or list of n-grams to look up
+            start_date (datetime): first day
+            end_date (datetime): last day
+
+        Returns (pd.Series or pd.DataFrame):
+            timeseries indexed by date (a series wraps the mapped values, a dataframe copies them)
+        """
+        cols = self.dates(start_date, end_date)
+        index = pd.date_range(self.start, periods=self.values.shape[1], freq='D')[cols] if self.start else None
+        index = pd.DatetimeIndex([] if index is None else index, name=self.metric)
+
+        if isinstance(ngrams, str):
+            return pd.Series(self.get(ngrams, start_date, end_date), index=index, name=ngrams, copy=False)
+
+        rows = [self.ngrams[w] for w in ngrams]
+        return pd.DataFrame(self.values[rows, cols].T, index=index, columns=list(ngrams))
+
+
+class Watermarks:
+    """Class to keep track of the last complete day fetched for every query target
+
+    Watermarks are kept in a small JSON file keyed by `{database}|{lang}|{target}`
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        """Open a file of watermarks
+
+        Args:
+            path (pathlib.Path): path to the JSON file
+        """
+        self.path = Path(path)
+
+    def read(self):
+        """Read all watermarks
+
+        Returns (dict):
+            a dictionary of dates keyed by target
+        """
+        if not self.path.exists():
+            return {}
+        with open(self.path) as f:
+            return {k: datetime.date.fromisoformat(v) for k, v in json.load(f).items()}
+
+    def get(self, key):
+        """Get the watermark of a target
+
+        Args:
+            key (string): target to use
+
+        Returns (datetime.date):
+            last complete day or None if the target has never been fetched
+        """
+        with self.lock:
+            return self.read().get(key)
+
+    def set(self, key, day):
+        """Move the watermark of a target forward
+
+        Args:
+            key (string): target to use
+            day (datetime.date): last complete day
+        """
+        with self.lock:
+            marks = self.read()
+            if key in marks and marks[key] >= day:
+                return
+
+            marks[key] = day
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({k: v.isoformat() for k, v in sorted(marks.items())}, f, indent=2)
+            os.replace(tmp, self.path)
+
+    def drop(self, key):
+        """Forget the watermark of a target, so it is fetched again from the first day
+
+        Args:
+            key (string): target to use
+        """
+        with self.lock:
+            marks = self.read()
+            if marks.pop(key, None) is None:
+                return
+
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({k: v.isoformat() for k, v in sorted(marks.items())}, f, indent=2)
+            os.replace(tmp, self.path)
+
+
+class Journal:
+    """Class to keep track of the units of work finished by a run
+
+    Every finished `(target, lang, metric)` unit is appended to a file of JSON lines,
+    so a run that died partway through can be resumed without doing them again;
+    the journal is removed once a run completes
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, path, resume=False):
+        """Open a run journal
+
+        Args:
+            path (pathlib.Path): path to the JSON lines file
+            resume (bool): a toggle to keep the units of the last run (a new journal is started otherwise)
+        """
+        self.path = Path(path)
+        self.done = set()
+
+        if not resume:
+            self.path.unlink(missing_ok=True)
+        elif self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self.done.add(tuple(json.loads(line)))
+                    except json.JSONDecodeError:
+                        # the last line may have been cut short by a crash
+                        continue
+            logger.info(f'Resuming: {len(self.done)} units already done ({self.path})')
+
+    def finished(self, target, lang, metric):
+        """Check if a unit has been done by the run
+
+        Args:
+            target (string): target to use (e.g. path to its timeseries)
+            lang (string): language collection
+            metric (string): metric to use
+
+        Returns (bool):
+            True if the unit is done
+        """
+        return (str(target), lang, metric) in self.done
+
+    def record(self, target, lang, metric):
+        """Mark a unit as done
+
+        Args:
+            target (string): target to use (e.g. path to its timeseries)
+            lang (string): language collection
+            metric (string): metric to use
+        """
+        unit = (str(target), lang, metric)
+        with self.lock:
+            self.done.add(unit)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(unit, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def close(self):
+        """Remove the journal of a completed run"""
+        with self.lock:
+            self.path.unlink(missing_ok=True)
+            self.done = set()
+
+
+def load_timeseries(save_path, metric, start_date=None, end_date=None):
+    """Load a metric from every store of timeseries with compact dtypes
+
+    N-grams are interned in a categorical column index shared by all matrices
+
+    Args:
+        save_path (pathlib.Path): path to the generated timeseries
+        metric (string): metric to use (e.g. 'count', 'rank_no_rt')
+        start_date (datetime): first day to load
+        end_date (datetime): last day to load
+
+    Returns (dict):
+        a dictionary of (T x N) dataframes keyed by store path (e.g. 'raw/april_top_1grams/English')
+    """
+    save_path = Path(save_path)
+    dfs = {
+        str(p.parent.relative_to(save_path)): TimeseriesStore(p.parent).load(metric, start_date, end_date, compact=True)
+        for p in sorted(save_path.rglob('parquet'))
+        if (p / metric).is_dir()
+    }
+
+    words = pd.Index(sorted(set().union(*(df.columns for df in dfs.values()))), dtype=str)
+    for df in dfs.values():
+        df.columns = pd.CategoricalIndex(df.columns, categories=words)
+    return dfs
+
+
+def lookup(save_path, ngram, metric='count', start_date=None, end_date=None):
+    """Look up an n-gram in every packed store of timeseries
+
+    Args:
+        save_path (pathlib.Path): path to the generated timeseries
+        ngram (string): n-gram to look up
+        metric (string): metric to use
+        start_date (datetime): first day
+        end_date (datetime): last day
+
+    Returns (dict):
+        a dictionary of timeseries keyed by store path (e.g. 'raw/april_top_1grams/English')
+    """
+    save_path = Path(save_path)
+    found = {}
+    for p in sorted(save_path.rglob(f'npy/{metric}.json')):
+        m = PackedMatrix(p.parent.parent, metric)
+        if ngram in m:
+            found[str(p.parent.parent.relative_to(save_path))] = m.series(ngram, start_date, end_date)
+    return found
+
+
+def export_timeseries(save_path):
+    """Export every store of timeseries to the published TSV layout and to memory-mapped matrices
+
+    Metrics whose partitions have not been rewritten since the last export are left as they are
+
+    Args:
+        save_path (pathlib.Path): path to the generated timeseries
+    """
+    exported, total = 0, 0
+    for p in sorted(Path(save_path).rglob('parquet')):
+        ts = TimeseriesStore(p.parent)
+        for m in sorted(d.name for d in p.iterdir() if d.is_dir()):
+            exported += ts.export(m) | ts.pack(m)
+            total += 1
+    logger.info(f'Exported: {exported}/{total} metrics with new days')
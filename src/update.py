@@ -1,16 +1,17 @@
-
 import sys
 import time
 import logging
 from pathlib import Path
+from functools import partial
 from datetime import datetime
-import contagiograms
+import pandas as pd
 
-import vis
 import cli
 import utils
 import consts
-
+import instrument
+import timeseries
+from backends import MongoBackend, ParquetBackend, close_clients
 
 logging.basicConfig(
     stream=sys.stdout,
@@ -30,43 +31,155 @@ def main(args=None):
     args = cli.parse_args(args)
     Path(outdir).mkdir(parents=True, exist_ok=True)
 
-    if args.dtype == 'figures':
-
-        jhu = Path(args.jhu) / 'csse_covid_19_data/csse_covid_19_time_series'
-        confirmed = jhu / 'time_series_covid19_confirmed_global.csv'
-        deaths = jhu / 'time_series_covid19_deaths_global.csv'
-        us_confirmed = jhu / 'time_series_covid19_confirmed_US.csv'
-        us_deaths = jhu / 'time_series_covid19_deaths_US.csv'
-
-        contagiograms.plot(
-            consts.contagiograms,
-            savepath=plots,
-            start_date=datetime(2020, 1, 1),
-            t1="1W",
-            t2=7,
-        )
-        
-        vis.cases(
-            savepath=plots / f'coronagrams_cases',
-            words_by_country=consts.words_by_country,
-            deaths=deaths,
-            confirmed=confirmed,
-            us_deaths=us_deaths,
-            us_confirmed=us_confirmed,
-            lang_hashtbl=Path(langs),
-        )
-
-    else:
-        for f in targets.rglob('*grams'):
-            logging.info(f'{f.parent.stem}|{f.stem}')
-
-            utils.update_timeseries(
-                save_path=outdir/f.parent.stem/f.stem,
-                languages_path=langs,
-                ngrams_path=f,
-                database=f.stem.split('_')[-1]
+    instrument.configure(args.metrics if args.metrics else repo/'data'/'metrics.jsonl')
+    run = datetime.now().isoformat(timespec='seconds')
+
+    with instrument.profile(args.profile), \
+            instrument.context(run=run, mode=args.dtype or 'update'), \
+            instrument.stage('run'):
+        if args.dtype == 'figures':
+            # plotting modules are only loaded for figures
+            import vis
+            import derived
+            from query import Query
+            from cache import QueryCache
+            from jhu import CaseCounts
+            from derived import DerivedSeries
+            from fingerprints import Fingerprints, fingerprint
+
+            cache = QueryCache(args.cache if args.cache else repo/'data'/'cache')
+            plots.mkdir(parents=True, exist_ok=True)
+
+            jhu = Path(args.jhu) / 'csse_covid_19_data/csse_covid_19_time_series'
+            confirmed = jhu / 'time_series_covid19_confirmed_global.csv'
+            deaths = jhu / 'time_series_covid19_deaths_global.csv'
+            us_confirmed = jhu / 'time_series_covid19_confirmed_US.csv'
+            us_deaths = jhu / 'time_series_covid19_deaths_US.csv'
+
+            jhu = [confirmed, deaths, us_confirmed, us_deaths]
+
+            with instrument.stage('fetch', figure='coronagrams_cases'):
+                ngrams, deaths, confirmed = vis.fetch_cases(
+                    words_by_country=consts.words_by_country,
+                    deaths=deaths,
+                    confirmed=confirmed,
+                    us_deaths=us_deaths,
+                    us_confirmed=us_confirmed,
+                    lang_hashtbl=Path(langs),
+                    store=args.store,
+                    cache=cache,
+                    counts=CaseCounts(repo/'data'/'jhu'),
+                )
+
+            with instrument.stage('derive', figure='coronagrams_cases'):
+                layers = DerivedSeries(repo/'data'/'derived').update_all(
+                    derived.cases_series(ngrams, deaths, confirmed)
+                )
+
+            # contagiograms are drawn in the workers from the series fetched here
+            with instrument.stage('fetch', figure='contagiograms'):
+                series = Query.query_many(
+                    [p for words in consts.contagiograms.values() for p in words],
+                    start_time=datetime(2020, 1, 1),
+                    store=args.store,
+                    cache=cache,
+                )
+
+            languages = pd.read_csv(langs, header=0, index_col=1, comment='#')['Language'].to_dict()
+
+            jobs, digests, outputs = {}, {}, {}
+            for name, words in consts.contagiograms.items():
+                params = dict(words=words, start_date=datetime(2020, 1, 1), t1="1W", t2=7)
+                f = f'contagiograms_{name}'
+                jobs[f] = partial(
+                    vis.plot_contagiograms,
+                    plots / f,
+                    {p: series[p] for p in words},
+                    languages,
+                    start_date=params['start_date'],
+                    t1=params['t1'],
+                    t2=params['t2'],
+                )
+                digests[f] = fingerprint(params, [series[p] for p in words])
+                outputs[f] = [plots / f'{f}.pdf', plots / f'{f}.png']
+
+            # the grid is drawn once for both formats and labeled with the date of the last update
+            params = dict(words=consts.words_by_country, date=datetime.today().date())
+            f = 'coronagrams_cases'
+            jobs[f] = partial(vis.plot_cases, plots / f, formats=('pdf', 'png'), **layers)
+            digests[f] = fingerprint(params, jhu, layers)
+            outputs[f] = [plots / f'{f}.pdf', plots / f'{f}.png']
+
+            marks = Fingerprints(plots / '.fingerprints.json')
+            jobs = {f: job for f, job in jobs.items() if args.force or marks.changed(f, digests[f], outputs[f])}
+            logging.info(f'Rendering {len(jobs)}/{len(digests)} figures with changed inputs')
+
+            vis.render(jobs, processes=args.processes)
+            for f in jobs:
+                marks.set(f, digests[f])
+            logging.info(f'Query cache: {cache.stats()}')
+
+        elif args.dtype == 'rtd':
+            import rtd
+            rtd.top_ngrams(
+                reference=Path(args.reference),
+                current=Path(args.current),
+                savepath=Path(args.savepath),
+                alpha=args.alpha,
+                topk=args.topk,
+                rising=not args.all,
+            )
+
+        elif args.dtype == 'export':
+            timeseries.export_timeseries(outdir)
+
+        elif args.dtype == 'mirror':
+            for f in targets.rglob('*grams'):
+                logging.info(f'{f.parent.stem}|{f.stem}')
+
+                utils.mirror_ngrams(
+                    store=Path(args.store),
+                    languages_path=langs,
+                    ngrams_path=f,
+                    database=f.stem.split('_')[-1]
+                )
+
+            words = [w for ws in consts.contagiograms.values() for w in ws]
+            words += [w for ws in consts.words_by_country.values() for w in ws]
+            words = pd.DataFrame(
+                [(w, lang, f'{len(w.split())}grams') for w, lang in words],
+                columns=['word', 'lang', 'db']
+            )
+
+            for (db, lang), group in words.groupby(['db', 'lang']):
+                docs = MongoBackend(db, lang).find(group['word'].unique(), start_time=datetime(2019, 9, 1))
+                ParquetBackend(db, lang, args.store).ingest(docs)
+
+        else:
+            tasks = []
+            for f in targets.rglob('*grams'):
+                logging.info(f'{f.parent.stem}|{f.stem}')
+
+                tasks += utils.timeseries_tasks(
+                    save_path=outdir/f.parent.stem/f.stem,
+                    languages_path=langs,
+                    ngrams_path=f,
+                    database=f.stem.split('_')[-1],
+                    store=args.store,
+                    overlap=args.overlap,
+                    case_index=args.case_index if args.case_index else repo/'data'/'case_index',
+                )
+
+            # finished units are journaled, so a failed run can be picked up with --resume
+            journal = timeseries.Journal(outdir/'journal.jsonl', resume=args.resume)
+            utils.run_tasks(
+                utils.plan_tasks(tasks, journal=journal),
+                workers=args.workers,
+                retries=args.retries,
             )
+            journal.close()
 
+    close_clients()
     logging.info(f'Total time elapsed: {time.time() - timeit:.2f} sec.')
 
 
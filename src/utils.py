@@ -1,162 +1,480 @@
 
-import regex as re
+import time
 import datetime
+import threading
+import contextvars
 import pandas as pd
-import numpy as np  
+import instrument
 from query import Query
+from backends import MongoBackend, ParquetBackend, casefold
+from timeseries import TimeseriesStore, Watermarks
+from rules import RuleSet
 from pathlib import Path
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def filter_ngrams(save_path, ngrams_path, languages_path):
+def filter_file(file, save_path, lang_code):
+    """Filter out Twitter-specific content from a ranked list of n-grams
+
+    Args:
+        file (pathlib.Path): path to a ranked list of n-grams
+        save_path (pathlib.Path): path to save filtered n-grams
+        lang_code (string): language code to select cleaning rules
+
+    Returns (pd.DataFrame):
+        number of n-grams removed and time spent by rule
+    """
+    ngrams = pd.read_csv(
+        file,
+        na_filter=False,
+        sep='\t',
+        encoding='utf8',
+        header=None,
+        quotechar=None,
+        quoting=3,
+        names=['ngram', 'rankdiv']
+    )
+
+    out = Path(f'{save_path}')
+    out.mkdir(parents=True, exist_ok=True)
+
+    rules = RuleSet.for_language(lang_code)
+    ngrams = ngrams[rules.apply(ngrams['ngram'])]
+    ngrams.set_index('ngram', inplace=True)
+    ngrams.to_csv(f'{save_path / file.stem}.tsv', sep='\t', header=False)
+    logger.info(f'{save_path / file.stem}.tsv')
+    return rules.report()
+
+
+def filter_tasks(save_path, ngrams_path, languages_path):
+    """List files to filter
+
+    Args:
+        save_path (pathlib.Path): path to save filtered n-grams
+        ngrams_path (pathlib.Path): path to parse requested ngrams
+        languages_path (pathlib.Path): path to parse requested languages
+
+    Returns (list):
+        list of (file, save_path, lang_code) tuples for `filter_file`
+    """
+    supported_languages = pd.read_csv(languages_path, header=0, index_col=1, comment='#')
+    return [
+        (file, save_path, lang_code)
+        for lang_code in supported_languages.index
+        for file in sorted(ngrams_path.glob(f'{lang_code}_*.tsv'))
+    ]
+
+
+def filter_ngrams(save_path, ngrams_path, languages_path, processes=None):
     """Filter out Twitter-specific content
 
     Args:
         save_path (pathlib.Path): path to save generated timeseries
         ngrams_path (pathlib.Path): path to parse requested ngrams
         languages_path (pathlib.Path): path to parse requested languages
+        processes (int): number of files to filter in parallel (defaults to all cores)
+
+    Returns (pd.DataFrame):
+        number of n-grams removed and time spent by rule
     """
-    supported_languages = pd.read_csv(languages_path, header=0, index_col=1, comment='#')
-    regex = re.compile(
-        r'(RT)|(rt)|'  # retweet prefix
-        r'(&\S+;)|'  # html codes
-        r'([^\P{P}]+)|'  # punctuations
-        r'([^\P{M}]+)|'  # accents
-        r'([^\P{S}]+)|'  # symbols
-        r'([^\P{Z}]+)|'  # separators
-        r'([^\P{C}]+)|'  # others
-        r'(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+\S+)',  # links
-    )
+    tasks = filter_tasks(save_path, ngrams_path, languages_path)
+    if not tasks:
+        return RuleSet().report().iloc[:0]
 
-    for lang_code in supported_languages.index:
-        for file in ngrams_path.glob(f'{lang_code}_*.tsv'):
-            print(file)
+    with Pool(processes=processes) as pool:
+        reports = pool.starmap(filter_file, tasks)
 
-            ngrams = pd.read_csv(
-                file,
-                na_filter=False,
-                sep='\t',
-                encoding='utf8',
-                header=None,
-                quotechar=None,
-                quoting=3,
-                names=['ngram', 'rankdiv']
-            )
+    return pd.concat(reports).groupby(level=0, sort=False).sum()
 
-            out = Path(f'{save_path}')
-            out.mkdir(parents=True, exist_ok=True)
 
-            inds = []
-            for k, i in enumerate(ngrams['ngram']):
-                ws = i.split(' ')
+def target_name(save_path, file):
+    """Name a list of n-grams after its place in the timeseries tree
 
-                if any([bool(w.startswith('@')) for w in ws]):
-                    inds.append(k)
+    Args:
+        save_path (pathlib.Path): path to save generated timeseries (e.g. `{outdir}/raw/april_top_1grams/English`)
+        file (pathlib.Path): path to a ranked list of n-grams
+
+    Returns (string):
+        name of the target, e.g. 'raw/april_top_1grams|en_top_1grams'
+    """
+    return f"{'/'.join(Path(save_path).parts[-3:-1])}|{Path(file).stem}"
 
-                if any([bool(regex.findall(w)) for w in ws]):
-                    inds.append(k)
 
-            ngrams = ngrams.drop(inds)
-            ngrams.set_index('ngram', inplace=True)
-            ngrams.to_csv(f'{save_path / file.stem}.tsv', sep='\t', header=False)
-            logger.info(f'{save_path / file.stem}.tsv')
+def lang_metrics(rt=True):
+    """List the metrics kept for a list of n-grams
 
-        logger.info('-' * 50)
+    Args:
+        rt (bool): a toggle to include retweets
+
+    Returns (list):
+        list of metrics, e.g. ['count', 'rank', 'freq']
+    """
+    return ['count', 'rank', 'freq'] if rt else ['count_no_rt', 'rank_no_rt', 'freq_no_rt']
 
 
-def query_lang_array(
+def reset_case_insensitive(save_path, lang, database):
+    """Clear the timeseries of a case-insensitive list filled before capitalizations were folded together
+
+    Older stores hold case-sensitive series (or summed ranks), so their partitions are cleared once
+    and fetched again from the first day; the date of the reset is kept as a watermark.
+    Published files stay in place until the backfill is exported over them
+
+    Args:
+        save_path (pathlib.Path): path to save generated timeseries
+        lang (string): language collection
+        database (string): database codename
+    """
+    marks = Watermarks(Path(save_path) / 'watermarks.json')
+    key = f'{database}|{lang}|case_insensitive'
+    if marks.get(key):
+        return
+
+    logger.warning(f'Backfilling: {save_path} with capitalizations folded together')
+    ts = TimeseriesStore(save_path)
+    for rt in (True, False):
+        for m in lang_metrics(rt):
+            ts.reset(m)
+        marks.drop(f"{database}|{lang}|{'rt' if rt else 'no_rt'}")
+
+    Path(save_path).mkdir(parents=True, exist_ok=True)
+    marks.set(key, datetime.date.today())
+
+
+def lang_start_date(
         save_path,
         lang,
         database,
-        ngrams,
         rt=True,
-        start_date=datetime.datetime(2019, 9, 1)
+        start_date=datetime.datetime(2019, 9, 1),
+        overlap=2,
+        metrics=None,
 ):
-    """Query a given language collection in the database
+    """Find the first day to fetch for a language
 
     Args:
         save_path (pathlib.Path): path to save generated timeseries
         lang (string): language collection
         database (string): database codename
-        ngrams (list): a list of ngrams to query
         rt (bool): a toggle to include retweets
-        start_date (datetime): starting date for the query
+        start_date (datetime): starting date if nothing has been fetched yet
+        overlap (int): number of days before the watermark to fetch again for late corrections
+        metrics (list): metrics to look up if there is no watermark (defaults to all metrics of the list)
+
+    Returns (datetime):
+        starting date for the query
     """
-    if rt:
-        dfs = {
-            'count': None,
-            'rank': None,
-            'freq': None
-        }
-    else:
-        dfs = {
-            'count_no_rt': None,
-            'rank_no_rt': None,
-            'freq_no_rt': None
-        }
-
-    if Path(f'{save_path}/count.tsv').exists():
-        t = datetime.date.today() - datetime.timedelta(10)
+    marks = Watermarks(Path(save_path) / 'watermarks.json')
+    key = f"{database}|{lang}|{'rt' if rt else 'no_rt'}"
+
+    last = marks.get(key)
+    if last is None:
+        # without a watermark, every metric has to catch up from the one that is furthest behind
+        ts = TimeseriesStore(save_path)
+        days = [ts.last_day(m) for m in (metrics or lang_metrics(rt))]
+        last = None if None in days else min(days)
+
+    if last:
+        t = last - datetime.timedelta(overlap)
         start_date = datetime.datetime(t.year, t.month, t.day)
+    return start_date
+
 
-    q = Query(database, lang)
-    logger.info(f'Starting date: {start_date.date()}')
-    d_arr = q.query_timeseries_array(list(ngrams), start_time=start_date).reset_index(drop=True)
+def save_lang_array(save_path, lang, database, dfs, rt=True, journal=None):
+    """Merge new days into the timeseries of a language and move its watermark forward
+
+    Args:
+        save_path (pathlib.Path): path to save generated timeseries
+        lang (string): language collection
+        database (string): database codename
+        dfs (dict): a dictionary of (T x N) dataframes keyed by metric
+        rt (bool): a toggle to include retweets
+        journal (timeseries.Journal): run journal to record every metric written to
+    """
+    ts = TimeseriesStore(save_path)
+    marks = Watermarks(Path(save_path) / 'watermarks.json')
+    key = f"{database}|{lang}|{'rt' if rt else 'no_rt'}"
 
     for k in dfs.keys():
-        to_update = d_arr.pivot_table(index='time', columns='word', values=k)
-        to_update = to_update[to_update.index == to_update.index]  # remove NaTs in index
-        dfs[k] = to_update
-        dfs[k].index.name = k
-        file = Path(f'{save_path}/{k}.tsv')
+        with instrument.stage('write', metric=k):
+            ts.upsert(k, dfs.get(k))
+        if journal is not None:
+            journal.record(save_path, lang, k)
+
+    days = dfs[next(iter(dfs))].index
+    days = days[days.date < datetime.date.today()]
+    if not days.empty:
+        marks.set(key, days.max().date())
+        logger.info(f'Watermark: {days.max().date()}')
+
 
-        if file.exists():
-            old = pd.read_csv(file, header=0, index_col=0, na_filter=False, sep='\t')
-            old[old == ''] = np.nan
+def read_ngrams(file, topk=1000):
+    """Read a list of requested n-grams
 
-            old = old.combine_first(dfs.get(k))
-            old.to_csv(file, sep='\t')
-        else:
-            dfs.get(k).to_csv(file, sep='\t')
+    Args:
+        file (pathlib.Path): path to a ranked list of n-grams
+        topk (int): number of n-grams to keep
+
+    Returns (np.array):
+        array of n-grams
+    """
+    return pd.read_csv(
+        file,
+        na_filter=False,
+        sep='\t',
+        encoding='utf8',
+        header=None,
+        quotechar=None,
+        quoting=3
+    ).iloc[:, 0].values[:topk]
 
 
-def update_timeseries(save_path, languages_path, ngrams_path, database):
-    """Query database to update timeseries
+def timeseries_tasks(save_path, languages_path, ngrams_path, database, store=None, overlap=2, case_index=None):
+    """List tasks to update timeseries
 
     Args:
         save_path (pathlib.Path): path to save generated timeseries
         languages_path (pathlib.Path): path to parse requested languages
         ngrams_path (pathlib.Path): path to parse requested ngrams
         database (string): database codename
+        store (pathlib.Path): path to a local store to use instead of the database server
+        overlap (int): number of days before the watermark to fetch again for late corrections
+        case_index (pathlib.Path): path to a local directory of case-folded lookups
+
+    Returns (list):
+        list of (name, kwargs) tuples, one per list of n-grams (see `plan_tasks`)
     """
-    topk = 1000
     supported_languages = pd.read_csv(languages_path, header=0, index_col=1, comment='#')
 
+    tasks = []
     for lang_code in supported_languages.index:
         lang = supported_languages.loc[lang_code].Language
 
-        for file in ngrams_path.glob(f'{lang_code}_*.tsv'):
-            logger.info(f'{lang}: {file.stem}\n')
-            ngrams = pd.read_csv(
-                file,
-                na_filter=False,
-                sep='\t',
-                encoding='utf8',
-                header=None,
-                quotechar=None,
-                quoting=3
-            ).iloc[:, 0].values[:topk]
-
-            out = Path(f'{save_path}/{lang}/')
-            out.mkdir(parents=True, exist_ok=True)
-
-            logger.info(f"Retrieving: {len(ngrams)} {database} ...")
-            if file.stem.endswith('no_rt'):
-                query_lang_array(out, lang_code, database, ngrams, rt=False)
+        for file in sorted(ngrams_path.glob(f'{lang_code}_*.tsv')):
+            tasks.append((
+                f'{save_path.parent.stem}|{save_path.stem}|{lang}|{file.stem}',
+                dict(
+                    save_path=Path(f'{save_path}/{lang}/'),
+                    file=file,
+                    lang_code=lang_code,
+                    database=database,
+                    store=store,
+                    overlap=overlap,
+                    case_insensitive='case_insensitive' in ngrams_path.stem,
+                    case_index=case_index,
+                )
+            ))
+    return tasks
+
+
+def plan_tasks(tasks, journal=None):
+    """Group tasks that query the same collection, so every n-gram is fetched once
+
+    Lists matched as they are and regardless of capitalization share a group
+
+    Args:
+        tasks (list): list of (name, kwargs) tuples from `timeseries_tasks`
+        journal (timeseries.Journal): run journal to skip and record finished units
+
+    Returns (list):
+        list of (name, kwargs) tuples for `update_group`
+    """
+    groups = {}
+    for name, kwargs in tasks:
+        key = (
+            kwargs['database'],
+            kwargs['lang_code'],
+            str(kwargs['store']),
+            str(kwargs['case_index']),
+        )
+        groups.setdefault(key, []).append(kwargs)
+
+    return [
+        (f'{database}|{lang_code}', dict(targets=targets, journal=journal))
+        for (database, lang_code, *_), targets in groups.items()
+    ]
+
+
+def update_group(targets, journal=None):
+    """Query database once to update timeseries for several lists of n-grams of a collection
+
+    Every n-gram is fetched a single time with all metrics,
+    from the earliest day any of the lists needs it (regardless of capitalization);
+    case-sensitive lists are cut from the same documents as case-insensitive ones
+    whenever they share an n-gram, and results are fanned out to the (T x N) matrices of every list
+
+    Args:
+        targets (list): list of task kwargs (see `timeseries_tasks`) sharing a database and language
+        journal (timeseries.Journal): run journal to skip and record finished (target, lang, metric) units
+    """
+    database = targets[0]['database']
+    lang_code = targets[0]['lang_code']
+
+    # n-grams are keyed by their case-folded form across all lists
+    units, spellings, heads, starts = [], {}, {}, {}
+    for t in targets:
+        case_insensitive = t['case_insensitive']
+        if case_insensitive:
+            reset_case_insensitive(t['save_path'], lang_code, database)
+
+        rt = not t['file'].stem.endswith('no_rt')
+        metrics = [
+            m for m in lang_metrics(rt)
+            if journal is None or not journal.finished(t['save_path'], lang_code, m)
+        ]
+        if not metrics:
+            logger.info(f"Skipping: {t['save_path']} ({t['file'].stem}) finished by the last run")
+            continue
+
+        start = lang_start_date(t['save_path'], lang_code, database, rt=rt, overlap=t['overlap'], metrics=metrics)
+
+        # first spelling of every n-gram in the list
+        columns = {}
+        for w in read_ngrams(t['file']):
+            columns.setdefault(casefold(w) if case_insensitive else w, w)
+        units.append((t, rt, start, columns, metrics))
+
+        for w in columns.values():
+            k = casefold(w)
+            starts[k] = min(starts.get(k, start), start)
+            if case_insensitive:
+                heads.setdefault(k, w)
             else:
-                query_lang_array(out, lang_code, database, ngrams)
+                spellings.setdefault(k, {})[w] = None
+
+    if not units:
+        return
+
+    q = Query(database, lang_code, store=targets[0]['store'], case_index=targets[0]['case_index'])
+    fetched = {False: {}, True: {}}
+
+    def collect(dfs, folded):
+        for m, df in dfs.items():
+            fetched[folded].setdefault(m, []).append(df)
+
+    with instrument.context(database=database, lang=lang_code, targets=len(targets)):
+        for start in sorted(set(starts.values())):
+            keys = [k for k, s in starts.items() if s == start]
+            folded = [heads[k] for k in keys if k in heads]
+            shared = [w for k in keys if k in heads for w in spellings.get(k, ())]
+            rest = [w for k in keys if k not in heads for w in spellings.get(k, ())]
+            logger.info(f"Retrieving: {len(keys)} {database} ({lang_code}) from {start.date()} ...")
+
+            if folded:
+                exact, folds = q.query_timeseries_matrices(exact=shared, folded=folded, start_time=start)
+                collect(exact, False)
+                collect(folds, True)
+            if rest:
+                exact, _ = q.query_timeseries_matrices(exact=rest, start_time=start)
+                collect(exact, False)
+
+    matrices = {f: {m: pd.concat(dfs, axis=1) for m, dfs in ms.items()} for f, ms in fetched.items()}
+    logger.info(f"Fetched: {len(starts)} {database} ({lang_code}) for {len(targets)} lists")
+
+    for t, rt, start, columns, metrics in units:
+        case_insensitive = t['case_insensitive']
+        labels = {heads[k] if case_insensitive else k: w for k, w in columns.items()}
+
+        dfs = {}
+        for m in metrics:
+            df = matrices[case_insensitive][m]
+            df = df.loc[df.index >= start, [c for c in df.columns if c in labels]]
+            dfs[m] = df.rename(columns=labels)
+        seen = pd.concat(dfs.values(), axis=1).notna().any(axis=1)
+
+        for m, df in dfs.items():
+            df = df[seen].dropna(axis=1, how='all').sort_index(axis=1)
+            df.index.name = m
+            dfs[m] = df
 
-        logger.info('-' * 50)
+        Path(t['save_path']).mkdir(parents=True, exist_ok=True)
+        with instrument.context(database=database, lang=lang_code, target=target_name(t['save_path'], t['file'])):
+            save_lang_array(t['save_path'], lang_code, database, dfs, rt=rt, journal=journal)
+
+
+def run_tasks(tasks, workers=1, retries=0, func=update_group):
+    """Run tasks to update timeseries in a bounded pool of threads
+
+    Tasks writing to the same files never run at the same time
+
+    Args:
+        tasks (list): list of (name, kwargs) tuples for `func` (see `plan_tasks`)
+        workers (int): number of tasks to run concurrently
+        retries (int): number of times to retry a failing task
+        func (callable): function to run every task with
+
+    Returns (pd.DataFrame):
+        wall time, number of attempts, and status of every task
+    """
+    def outputs(kwargs):
+        return tuple(sorted(
+            (str(t['save_path']), t['file'].stem.endswith('no_rt'))
+            for t in kwargs.get('targets', [kwargs])
+        ))
+
+    locks = {outputs(kwargs): threading.Lock() for name, kwargs in tasks}
+
+    def run(name, kwargs):
+        timeit = time.time()
+
+        with locks[outputs(kwargs)]:
+            for attempt in range(1, retries + 2):
+                try:
+                    logger.info(f'{name}: attempt {attempt}')
+                    with instrument.context(task=name, attempt=attempt):
+                        func(**kwargs)
+                    status = 'done'
+                    break
+                except Exception as e:
+                    logger.exception(f'{name}: {e}')
+                    status = 'failed'
+                    if attempt <= retries:
+                        time.sleep(2 ** attempt)
+
+        summary = dict(task=name, attempts=attempt, status=status, seconds=time.time() - timeit)
+        instrument.emit('task', **summary)
+        return summary
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # every task keeps the instrumentation tags of the caller
+            futures = [pool.submit(contextvars.copy_context().run, run, *t) for t in tasks]
+            summary = [f.result() for f in futures]
+    else:
+        summary = [run(*t) for t in tasks]
+
+    summary = pd.DataFrame(summary, columns=['task', 'attempts', 'status', 'seconds'])
+    for _, t in summary.iterrows():
+        logger.info(f'{t.task}: {t.status} in {t.seconds:.2f} sec. ({t.attempts} attempts)')
+
+    failed = summary[summary.status != 'done']
+    if not failed.empty:
+        raise RuntimeError(f'Failed to update: {", ".join(failed.task)}')
+
+    return summary
+
+
+def mirror_ngrams(store, languages_path, ngrams_path, database, start_date=datetime.datetime(2019, 9, 1)):
+    """Copy the daily documents of requested n-grams from the database server to a local store
+
+    Args:
+        store (pathlib.Path): path to the local store
+        languages_path (pathlib.Path): path to parse requested languages
+        ngrams_path (pathlib.Path): path to parse requested ngrams
+        database (string): database codename
+        start_date (datetime): starting date for the query
+    """
+    supported_languages = pd.read_csv(languages_path, header=0, index_col=1, comment='#')
+
+    for lang_code in supported_languages.index:
+        ngrams = set()
+        for file in ngrams_path.glob(f'{lang_code}_*.tsv'):
+            ngrams.update(read_ngrams(file))
 
+        if ngrams:
+            logger.info(f"Mirroring: {len(ngrams)} {database} ({lang_code}) ...")
+            docs = MongoBackend(database, lang_code).find(sorted(ngrams), start_time=start_date)
+            ParquetBackend(database, lang_code, store).ingest(docs)
@@ -1,15 +1,22 @@
 
 from __future__ import unicode_literals
+import os
 import numpy as np
 import pandas as pd
 import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from matplotlib.lines import Line2D
 import matplotlib.ticker as ticker
 
+import jhu
 import consts
+import derived
+import instrument
 from query import Query
 
 import warnings
@@ -27,11 +34,51 @@ def cases(
     us_deaths,
     us_confirmed,
     lang_hashtbl,
+    store=None,
+    cache=None,
 ):
     """ Plot a grid of case-counts and ngrams
 
     Args:
         savepath (pathlib.Path): path to save generated plot
+        words_by_country (dict): a dictionary of ngrams by country
+        deaths (pathlib.Path): path to death records by JHU
+        confirmed (pathlib.Path): path to case counts by JHU
+        us_deaths (pathlib.Path): path to death records by JHU for the US
+        us_confirmed (pathlib.Path): path to case counts by JHU for the US
+        lang_hashtbl (pathlib.Path): path to parse requested languages
+        store (pathlib.Path): path to a local store to use instead of the database server
+        cache (cache.QueryCache): cache of query results
+    """
+    ngrams, deaths, confirmed = fetch_cases(
+        words_by_country,
+        deaths=deaths,
+        confirmed=confirmed,
+        us_deaths=us_deaths,
+        us_confirmed=us_confirmed,
+        lang_hashtbl=lang_hashtbl,
+        store=store,
+        cache=cache,
+    )
+    series = derived.cases_series(ngrams, deaths, confirmed)
+    plot_cases(savepath, **{k: derived.smooth(v) for k, v in series.items()})
+    logger.info(f'Saved: {savepath}')
+
+
+def fetch_cases(
+    words_by_country,
+    deaths,
+    confirmed,
+    us_deaths,
+    us_confirmed,
+    lang_hashtbl,
+    store=None,
+    cache=None,
+    counts=None,
+):
+    """ Fetch case-counts and ngrams for `plot_cases`
+
+    Args:
         words_by_country (dict): a dictionary of ngrams by country
         deaths (pathlib.Path): path to death records by JHU
         confirmed (pathlib.Path): path to case counts by JHU
@@ -39,63 +86,47 @@ def cases(
         us_confirmed (pathlib.Path): path to case counts by JHU for the US
         words (list): a list of tuples ('ngram', 'isocode')
         lang_hashtbl (pathlib.Path): path to parse requested languages
+        store (pathlib.Path): path to a local store to use instead of the database server
+        cache (cache.QueryCache): cache of query results
+        counts (jhu.CaseCounts): columnar copies of the JHU time series
+
+    Returns (tuple):
+        a dictionary of ngrams by country, and dataframes of new deaths and cases by country
     """
-    us_deaths = pd.read_csv(
-        us_deaths, header=0
-    ).groupby(by=['Country_Region']).sum().drop(
-        ['UID', 'code3', 'FIPS', 'Lat', 'Long_', 'Population'],
-        axis=1
-    ).T
-
-    deaths = pd.read_csv(
-        deaths, header=0
-    ).groupby(by=['Country/Region']).sum().drop(['Lat', 'Long'], axis=1).T
-    deaths['United States'] = us_deaths
-    deaths.index = pd.to_datetime(deaths.index)
-    deaths = deaths.diff(periods=1)
-
-    us_confirmed = pd.read_csv(
-        us_confirmed, header=0
-    ).groupby(by=['Country_Region']).sum().drop(
-        ['UID', 'code3', 'FIPS', 'Lat', 'Long_'],
-        axis=1
-    ).T
-
-    confirmed = pd.read_csv(
-        confirmed, header=0
-    ).groupby(by=['Country/Region']).sum().drop(['Lat', 'Long'], axis=1).T
-    confirmed['United States'] = us_confirmed
-    confirmed.index = pd.to_datetime(confirmed.index)
-    confirmed = confirmed.diff(periods=1)
+    deaths = jhu.new_counts(deaths, us_deaths, counts=counts)
+    confirmed = jhu.new_counts(confirmed, us_confirmed, counts=counts)
 
     ngrams = {c: [] for c in list(words_by_country.keys())}
     supported_languages = pd.read_csv(lang_hashtbl, header=0, index_col=1, comment='#')
 
+    pairs = [p for words in words_by_country.values() for p in words]
+    logger.info(f"Retrieving {len(pairs)} n-grams")
+    data = Query.query_many(pairs, start_time=datetime.datetime(2020, 1, 1), store=store, cache=cache)
+
     for country, words in words_by_country.items():
         for w, lang in words:
             n = len(w.split())
-            logger.info(f"Retrieving {supported_languages.loc[lang].Language}: {n}gram -- '{w}'")
-
-            q = Query(f'{n}grams', lang)
-            d = q.query_timeseries(w, start_time=datetime.datetime(2020, 1, 1))
-
+            d = data[(w, lang)].copy()
+            logger.info(f"{supported_languages.loc[lang].Language}: {n}gram -- '{w}'")
             logger.info(f"Top rank: {d['rank'].min()} -- {d['rank'].idxmin().date()}")
             d.index.name = f"{supported_languages.loc[lang].Language}\n'{w}'"
-            d.index.name = f"{supported_languages.loc[lang].Language}\n'{w}'"
             ngrams[country].append(d)
 
-    plot_cases(savepath, ngrams, deaths, confirmed)
-    logger.info(f'Saved: {savepath}')
+    return ngrams, deaths, confirmed
 
 
-def plot_cases(savepath, ngrams, deaths, confirmed):
+def plot_cases(savepath, ranks, average, deaths, confirmed, formats=('pdf', 'png')):
     """Plot a grid of contagiograms
 
+    Series are plotted as they are; see `derived.cases_series` and `derived.smooth`
+
     Args:
         savepath (pathlib.Path): path to save plot
-        ngrams (dict): a dictionary of ngrams by country
-        deaths (pd.DataFrame): a dataframe of death records by JHU
-        confirmed (pd.DataFrame): a dataframe of case counts by JHU
+        ranks (pd.DataFrame): a dataframe of smoothed n-gram ranks keyed by (country, n-gram)
+        average (pd.DataFrame): a dataframe of smoothed average ranks by country
+        deaths (pd.DataFrame): a dataframe of smoothed new deaths by country
+        confirmed (pd.DataFrame): a dataframe of smoothed new cases by country
+        formats (tuple): file formats to save
     """
     plt.rcParams.update({
         'font.size': 10,
@@ -118,7 +149,6 @@ def plot_cases(savepath, ngrams, deaths, confirmed):
     minor_locator = mdates.AutoDateLocator()
     start_date = datetime.datetime(2020, 1, 1)
     end_date = datetime.datetime.today()-datetime.timedelta(days=2)
-    window_size = 7
 
     i = 0
     for r in np.arange(0, rows, step=4):
@@ -134,32 +164,26 @@ def plot_cases(savepath, ngrams, deaths, confirmed):
                 xycoords="axes fraction", fontsize=16,
             )
 
-            tss = []
-            for w in ngrams[list(consts.words_by_country.keys())[i]]:
-                w = w[:-2]
-                w.index = pd.to_datetime(w.index)
-                w['rank'] = w['rank'].fillna(maxr)
-                tss.append(w['rank'])
-
+            country = list(consts.words_by_country.keys())[i]
+            for w in ranks[country].columns:
                 ax.plot(
-                    w['rank'].rolling(window_size, center=True).mean(),
+                    ranks[country][w],
                     color='grey',
                     alpha=.3
                 )
 
-            tss = pd.DataFrame(tss).mean(axis=0)
             ax.plot(
-                tss.rolling(window_size, center=True).mean(),
+                average[country],
                 color='k',
             )
 
             tax.plot(
-                confirmed[list(consts.words_by_country.keys())[i]].rolling(window_size, center=True).mean(),
+                confirmed[country],
                 color='red'
             )
 
             tax.plot(
-                deaths[list(consts.words_by_country.keys())[i]].rolling(window_size, center=True).mean(),
+                deaths[country],
                 color='C1',
                 ls='--'
             )
@@ -266,6 +290,202 @@ def plot_cases(savepath, ngrams, deaths, confirmed):
             i += 1
 
     plt.subplots_adjust(top=0.97, right=0.97, hspace=0.2, wspace=.15)
-    plt.savefig(f'{savepath}.pdf', bbox_inches='tight', pad_inches=.25)
-    plt.savefig(f'{savepath}.png', dpi=300, bbox_inches='tight', pad_inches=.25)
+    if 'pdf' in formats:
+        plt.savefig(f'{savepath}.pdf', bbox_inches='tight', pad_inches=.25)
+    if 'png' in formats:
+        plt.savefig(f'{savepath}.png', dpi=300, bbox_inches='tight', pad_inches=.25)
+    plt.close(fig)
+
+
+def plot_contagiograms(savepath, series, languages, start_date, t1='1W', t2=7, formats=('pdf', 'png')):
+    """Plot a grid of contagiograms
+
+    Every panel shows the balance of retweets (RT) and organic tweets (OT) of an n-gram,
+    its relative social amplification by day of the week, and its rank over time
+
+    Args:
+        savepath (pathlib.Path): path to save plot
+        series (dict): a dictionary of dataframes (see `Query.query_many`) keyed by ('ngram', 'isocode'), one per panel
+        languages (dict): a dictionary of language names keyed by isocode
+        start_date (datetime): first day to plot
+        t1 (string): resampling rule of the RT/OT balance
+        t2 (int): window size (days) to smooth ranks
+        formats (tuple): file formats to save
+    """
+    plt.rcParams.update({
+        'font.size': 10,
+        'axes.titlesize': 14,
+        'axes.labelsize': 12,
+        'xtick.labelsize': 10,
+        'ytick.labelsize': 10,
+        'legend.fontsize': 10,
+    })
+
+    cols = 3
+    rows = int(np.ceil(len(series) / cols))
+    fig = plt.figure(figsize=(12, 16 * rows / 4))
+    gs = fig.add_gridspec(ncols=cols, nrows=rows * 20)
+
+    contagion = matplotlib.colors.LinearSegmentedColormap.from_list('contagion', ['dimgrey', 'white', 'C1', 'darkred'])
+    norm = matplotlib.colors.TwoSlopeNorm(vmin=0, vcenter=1, vmax=2)
+    major_locator = mdates.YearLocator()
+    major_format = '%b\n%Y'
+    minor_format = '%b'
+    minor_locator = mdates.AutoDateLocator()
+    # series are padded up to the day of the query
+    last = [df['count'].where(df['count'] > 0).last_valid_index() for df in series.values()]
+    end_date = max([d for d in last if d is not None], default=datetime.datetime.today())
+
+    for i, ((w, lang), df) in enumerate(series.items()):
+        r, c = divmod(i, cols)
+        df = df.loc[start_date:end_date]
+
+        # shares of retweets and organic tweets by week
+        weekly = df[['count', 'count_no_rt']].resample(t1).sum()
+        ot = (weekly['count_no_rt'] / weekly['count']).replace(np.inf, np.nan)
+        rt = 1 - ot
+
+        # retweet ratio of the n-gram relative to the retweet ratio of its language
+        total, total_no_rt = df['count'] / df['freq'], df['count_no_rt'] / df['freq_no_rt']
+        amplification = (df['count'] - df['count_no_rt']) / df['count_no_rt']
+        amplification /= (total - total_no_rt) / total_no_rt
+        amplification = amplification.replace([np.inf, -np.inf], np.nan)
+        weeks = amplification.index.to_period('W').start_time
+        grid = amplification.groupby([amplification.index.dayofweek, weeks]).mean().unstack()
+        grid = grid.reindex(index=range(7), columns=pd.date_range(weeks.min(), weeks.max(), freq='7D'))
+
+        # ranks are smoothed with their range over the same window
+        ranks = df['rank'].rolling(t2, center=True, min_periods=1)
+        smooth, low, high = ranks.mean(), ranks.min(), ranks.max()
+
+        bax = fig.add_subplot(gs[r*20:r*20+2, c])
+        hax = fig.add_subplot(gs[r*20+3:r*20+7, c])
+        ax = fig.add_subplot(gs[r*20+8:r*20+15, c])
+
+        bax.set_title(f"{languages.get(lang, lang)}\n'{w}'", fontsize=12)
+        bax.annotate(
+            consts.tags[i], xy=(-.1, 1.1), color='k', weight='bold',
+            xycoords="axes fraction", fontsize=16,
+        )
+
+        bax.plot(ot, color=consts.ot_color, label='OT')
+        bax.plot(rt, color=consts.rt_color, label='RT')
+        bax.fill_between(rt.index, 0, 1, where=(rt > ot).values, color='salmon', alpha=.4, lw=0, step='mid')
+        bax.axhline(.5, color='k', lw=1)
+        bax.set_ylim(0, 1)
+        bax.set_yticks([0, .5, 1])
+        bax.set_yticklabels(['0', '.5', '1'])
+
+        im = hax.imshow(
+            grid.values,
+            aspect='auto',
+            cmap=contagion,
+            norm=norm,
+            interpolation='none',
+            extent=[mdates.date2num(grid.columns[0]), mdates.date2num(grid.columns[-1] + pd.Timedelta(days=7)), 7, 0],
+        )
+        hax.set_yticks(np.arange(7) + .5)
+        hax.set_yticklabels(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'], fontsize=8)
+        for d in range(1, 7):
+            hax.axhline(d, color='k', lw=1)
+
+        ax.fill_between(smooth.index, low, high, color='grey', alpha=.3, lw=0)
+        ax.plot(smooth, color=consts.at_color)
+        if smooth.notna().any():
+            ax.plot(smooth.idxmin(), smooth.min(), 'o', color='red', alpha=.5, ms=8)
+
+        ax.set_ylim(1, 10 ** 6)
+        ax.invert_yaxis()
+        ax.set_yscale('log')
+        ax.set_yticks([10**i for i in range(7)], minor=False)
+        ax.set_yticklabels(['1', '10', '100', r'$10^3$', r'$10^4$', r'$10^5$', r'$10^6$'], minor=False)
+        ax.grid(True, which="both", axis='y', alpha=.3, lw=1, linestyle='-', color='lightgrey')
+
+        for a in (bax, hax, ax):
+            a.set_xlim(start_date, end_date)
+            a.xaxis.set_major_locator(major_locator)
+            a.xaxis.set_major_formatter(mdates.DateFormatter(major_format))
+            a.xaxis.set_minor_locator(minor_locator)
+            a.xaxis.set_minor_formatter(mdates.DateFormatter(minor_format))
+        for a in (bax, hax):
+            a.set_xticklabels([])
+            a.set_xticklabels([], minor=True)
+
+        if c == 0:
+            bax.set_ylabel('RT/OT\nBalance', rotation=0, ha='center', va='center', labelpad=30)
+            hax.set_ylabel(r'$R^{\mathrm{rel}}_{\tau, t, \ell}$', rotation=0, ha='center', va='center', labelpad=30)
+            ax.text(
+                -0.25, 0.5, r"$n$-gram"+"\nrank "+r"$r$", ha='center',
+                verticalalignment='center', transform=ax.transAxes,
+            )
+            ax.text(
+                -0.25, 0.05, "Less talked\nabout ↓", ha='center', fontsize=8,
+                verticalalignment='center', transform=ax.transAxes, color='grey'
+            )
+            ax.text(
+                -0.25, 0.95, "↑ More\ntalked about", ha='center', fontsize=8,
+                verticalalignment='center', transform=ax.transAxes, color='grey'
+            )
+
+        if c == cols - 1:
+            bax.legend(loc='center left', bbox_to_anchor=(1, .5), frameon=False, fontsize=8)
+            fig.colorbar(im, cax=hax.inset_axes([1.03, 0, .03, 1]), ticks=[0, 1, 2])
+
+    plt.subplots_adjust(top=0.97, right=0.92, hspace=0.2, wspace=.15)
+    if 'pdf' in formats:
+        plt.savefig(f'{savepath}.pdf', bbox_inches='tight', pad_inches=.25)
+    if 'png' in formats:
+        plt.savefig(f'{savepath}.png', dpi=300, bbox_inches='tight', pad_inches=.25)
+    plt.close(fig)
+
+
+def setup_worker(metrics=None, tags=None):
+    """Prepare a rendering process
+
+    Args:
+        metrics (pathlib.Path): path to append timing records
+        tags (dict): instrumentation tags of the parent process
+    """
+    matplotlib.use('Agg')
+    instrument.configure(metrics)
+    instrument.tags.set(tags or {})
+
+
+def draw(name, job):
+    """Render a single figure
+
+    Args:
+        name (string): name of the figure
+        job (callable): function to render the figure (e.g. a `functools.partial`)
+    """
+    with instrument.stage('render', figure=name):
+        job()
+    plt.close('all')
+    return name
+
+
+def render(jobs, processes=None):
+    """Render figures in a pool of processes, one figure per process
+
+    Workers are spawned rather than forked to start with a clean pyplot state
+    and without the database connections of the parent;
+    every figure is drawn from the series passed along with its job, so workers never query
+
+    Args:
+        jobs (dict): a dictionary of callables keyed by figure name
+        processes (int): number of figures to render in parallel (defaults to one per job, up to all cores)
+    """
+    if not jobs:
+        return
+
+    processes = processes if processes else min(len(jobs), os.cpu_count())
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=setup_worker,
+        initargs=(instrument.recorder.path, instrument.tags.get()),
+    ) as pool:
+        futures = [pool.submit(draw, name, job) for name, job in jobs.items()]
+        for f in futures:
+            logger.info(f'Rendered: {f.result()}')
 